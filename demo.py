@@ -4,16 +4,15 @@
 import configparser
 import datetime
 
-from kanboard import Kanboard
-
 import json2kanboard
+import kanboard_client
 
 # Import configuration
 config = configparser.ConfigParser()
 config.read("demo.example.conf")
 
 # Create Kanboard API instance
-kanboard_instance = Kanboard(
+kanboard_instance = kanboard_client.Client(
     config.get("kanboard","url"), 
     config.get("kanboard","user"), 
     config.get("kanboard","password") 
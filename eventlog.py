@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import atexit
+import collections
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+# Format of log lines in text mode
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+  '''
+  Formats log records as one JSON object per line (JSONL):
+
+  {"time": "...", "level": "INFO", "logger": "root", "message": "...",
+   "event": "project", "identifier": "ONBOARDING1234", ...}
+
+  'event' and the fields of the event are only present in records logged
+  with extra = {'event': name, 'fields': dict}, as done by Rollup.
+  '''
+
+  def format(self, record):
+
+    entry = {
+      'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage(),
+      }
+
+    # Structured events
+    if getattr(record, 'event', None):
+      entry['event'] = record.event
+      entry.update(getattr(record, 'fields', {}))
+
+    if record.exc_info:
+      entry['exception'] = self.formatException(record.exc_info)
+
+    return json.dumps(entry, default = str, ensure_ascii = False)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+  '''
+  Puts log records on a queue without formatting them. Messages are
+  formatted and written by the QueueListener thread, off the hot path.
+  Arguments to log calls must not be changed after the call.
+  '''
+
+  def prepare(self, record):
+    return record
+
+
+def setup(filename, level, log_format = 'text'):
+  '''
+  Configures the root logger to log to the file 'filename' from a
+  background thread. Log calls only put the record on a queue.
+
+  level: The log level (e.g. logging.INFO)
+
+  log_format: 'text' for the classic 'time:level:message' lines, or
+  'jsonl' for one JSON object per line (See JsonFormatter).
+
+  Returns the started logging.handlers.QueueListener. It is stopped
+  (And the queue flushed) when the process exits.
+  '''
+  file_handler = logging.FileHandler(filename)
+
+  if log_format == 'jsonl':
+    file_handler.setFormatter(JsonFormatter())
+  else:
+    file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+  log_queue = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(log_queue, file_handler)
+
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.addHandler(QueueHandler(log_queue))
+
+  listener.start()
+  atexit.register(listener.stop)
+
+  return listener
+
+
+class Rollup:
+  '''
+  Counts events in a unit of work (A project, a run, ...) and logs
+  them as one record when done, instead of one record per event.
+
+  event: The name of the event logged (e.g. 'project' or 'run')
+
+  fields: Fields to include in the record (e.g. identifier = 'ONBOARDING1')
+  '''
+
+  def __init__(self, event, **fields):
+    self.event = event
+    self.fields = fields
+    self.counts = collections.Counter()
+    self.start = time.perf_counter()
+
+    # Counters may be updated from several threads
+    self.lock = threading.Lock()
+
+  def count(self, name, n = 1):
+    '''
+    Adds n to the counter 'name'
+    '''
+    with self.lock:
+      self.counts[name] += n
+
+  def emit(self, level = logging.INFO, **fields):
+    '''
+    Logs the fields, the counters and the duration in seconds as
+    one record. Extra fields can be added (e.g. status = 'failed').
+    '''
+    data = dict(self.fields)
+    data.update(fields)
+    with self.lock:
+      data.update(self.counts)
+    data['seconds'] = round(time.perf_counter() - self.start, 3)
+
+    logging.log(level, "Rollup %s %s", self.event, data,
+      extra = {'event': self.event, 'fields': data})
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 # _*_ coding: utf-8
 
+import collections
+import copy
 import datetime
+import hashlib
 import logging
-import random
-import json
+import os
 
 import sys
+import threading
 
 
 '''
@@ -25,14 +28,19 @@ import configparser
 
 import kanboard
 
+import eventlog
+import kanboard_client
+import project_template
 
 
 # Valid user roles in a Kanboard project
-KANBOARD_ROLES = (
-  'project-member',
-  'project-viewer',
-  'project-manager'
-  )
+KANBOARD_ROLES = project_template.KANBOARD_ROLES
+
+# Golden project task ids by template file and checksum. See golden_project()
+_golden_tasks_by_template = {}
+
+# Only one thread at a time may look up or build a golden project
+_golden_lock = threading.Lock()
 
 def create_project(
     project_file,
@@ -45,7 +53,13 @@ def create_project(
     due_date = None,
     roles = {},
     placeholders = {},
-    keys = []
+    keys = [],
+    golden = False,
+    workload = None,
+    project_id = None,
+    only_template_tasks = None,
+    tag_index = None,
+    group_index = None
     ):
   '''
   Creates a Kanboard project with tasks from a JSON file.
@@ -96,6 +110,39 @@ def create_project(
   keys: If a JSON task has a value(s) in keys, the task will only be
   added to the kanboard project if ALL the keys passed to this function
   are in the set of JSON task keys. Keys are case insensitive. 
+
+  golden: If True, tasks are copied from a hidden "golden" project built
+  from the project_file (See golden_project()), and only the per project
+  fields are updated. Requests are sent in JSON-RPC batches.
+
+  workload: A WorkloadIndex used for picking the least loaded member
+  when a task owner is a group. Share one between calls to count the
+  open tasks only once per run. If not set, one is created.
+
+  tag_index: A TagIndex creating the tags of the tasks as global tags
+  before the tasks are created, if it uses global tags. Share one between
+  calls to look up and create every tag only once per run. If not set,
+  Kanboard creates the tags in the project.
+
+  group_index: A GroupIndex used for finding the members of groups owning
+  tasks. Share one between calls to fetch each group only once per run.
+  If not set, one is created.
+
+  project_id: Add the tasks to this existing project instead of creating
+  a new project. Users from the project_file are not added.
+
+  only_template_tasks: Only create the tasks with these template task ids
+  (See project_template.template_task_ids()). Used by reconcile_project().
+
+  Every task is tagged with its template task id in the task metadata
+  'template_task', and the project with the checksum of the project_file
+  and the due date in the project metadata 'template_checksum' and
+  'due_date'.
+
+  The project_file is checked before any request is sent. If it is
+  invalid (See project_template.validate()), nothing is created.
+
+  Returns the id of the new project, or None if it was not created.
   '''
   
   # FIXME: Check input data
@@ -104,7 +151,31 @@ def create_project(
 
   # Keys must be a list
   assert type(keys) == type([])
+
+  # Counts what is created. Logged as one record when done.
+  rollup = eventlog.Rollup(
+    'project',
+    template = project_file,
+    identifier = project_identifier,
+    project_id = project_id
+    )
   
+  # Load and check the project data from the JSON file
+  try:
+    template = project_template.check(project_file)
+  except project_template.TemplateError as e:
+    logging.error("%s. Not creating project.", e)
+    rollup.emit(logging.ERROR, status = 'invalid_template')
+    return None
+
+  project_data = template.data
+
+  # Checksum of the JSON file. Tells when the project must be reconciled.
+  checksum = template.checksum
+
+  # Stable ids of the tasks in the JSON file
+  task_template_ids = template.task_ids
+
   # Make all roles values (User ids) are strings
   for k in roles.keys():
     roles[k] = str(roles[k])
@@ -117,37 +188,37 @@ def create_project(
   # This user will own all tasks
   all_tasks_owner = task_owner
 
-  # Get all Kanboard users
-  users = kb.get_all_users()
+  # Open tasks by user for assigning tasks to groups
+  if workload is None:
+    workload = WorkloadIndex(kb)
+
+  # Tag ids by name for creating the tags of the tasks
+  if tag_index is None:
+    tag_index = TagIndex(kb)
+
+  # Members of groups by group name
+  if group_index is None:
+    group_index = GroupIndex(kb)
 
   # A dictionary of users with username as key
   users_by_username = {u['username']:u for u in kb.get_all_users()}
-  
-  # Get all Kanboard groups
-  groups_by_name = {g['name']:g for g in kb.get_all_groups() }
-  
-  # Add list of members to groups
-  for group_data in groups_by_name.values():
-    group_data['members'] = kb.get_group_members(
-      group_id = group_data['id']
-      )
 
   # Keep track of latest due date
   latest_due_date = due_date
 
   # Project identifier must be unique
-  if project_identifier:
+  if project_identifier and not project_id:
     r = kb.get_project_by_identifier(identifier = project_identifier)
     if r:
-      logging.error("Error: identifier '{}' not unique. Not creating project"
-        .format(project_identifier))
+      logging.error("Error: identifier '%s' not unique. Not creating project",
+        project_identifier)
+      rollup.emit(logging.ERROR, status = 'not_unique')
       return None
 
   #FIXME: Identifier is alphanumeric only?
 
-  # Load the project data from the JSON file
-  with open(project_file) as config_file:
-      project_data = json.load(config_file)
+  # Metadata to save when all tasks are created
+  metadata_calls = []
 
 
   # Get project title from JSON if not supplied
@@ -164,8 +235,8 @@ def create_project(
 
   # Abort if no project name
   if not project_title:
-    logging.error("Project has no title"
-      .format(project_title))
+    logging.error("Project has no title")
+    rollup.emit(logging.ERROR, status = 'no_title')
     return None
 
   # Get owner from JSON if not supplied to function
@@ -179,33 +250,51 @@ def create_project(
   if not project_owner:
     # FIXME: JSON owner?
     # FIXME: Function owner?
-    logging.error("Owner '{}' for project '{}' is not a Kanboard user"
-      .format(project_owner, project_title))
+    logging.error("Owner '%s' for project '%s' is not a Kanboard user",
+      project_owner, project_title)
+    rollup.emit(logging.ERROR, status = 'no_owner')
     return None
 
-  logging.info("Project owner is '{}' for project {}"
-    .format(project_owner['name'], project_title))
+  logging.info("Project owner is '%s' for project %s",
+    project_owner['name'], project_title)
     
+  # Look up or build the golden project first. Without it, the project
+  # would be created without tasks.
+  if golden:
+    golden_tasks = golden_project(project_file, kb, project_owner['id'], template)
+    if golden_tasks is None:
+      logging.error("No golden project for '%s'. Not creating project '%s'",
+        project_file, project_title)
+      rollup.emit(logging.ERROR, status = 'no_golden_project')
+      return None
+
   # FIXME: Notification?
 
   # FIXME: Support for swimlanes?
 
   # Create project in Kanboard
-  new_project_id = kb.create_project(
-    name = project_title,
-    description = project_description,
-    owner_id = project_owner['id'],
-    identifier = project_identifier
-  )
+  if not project_id:
+    new_project_id = kb.create_project(
+      name = project_title,
+      description = project_description,
+      owner_id = project_owner['id'],
+      identifier = project_identifier
+    )
+
+  # Use the existing project
+  else:
+    new_project_id = project_id
+    project_title = kb.get_project_by_id(project_id = project_id)['name']
 
   # Abort if project not created
   if not new_project_id:
-    logging.error("Could not create project '{}' with owner '{}' in Kanboard"
-      .format(project_title, project_owner['name']))
+    logging.error("Could not create project '%s' with owner '%s' in Kanboard",
+      project_title, project_owner['name'])
+    rollup.emit(logging.ERROR, status = 'failed')
     return None
-  else:
-    logging.info("Created project '{}' with owner '{}' and id '{}' in Kanboard"
-      .format(project_title, project_owner['name'], new_project_id))
+  elif not project_id:
+    logging.info("Created project '%s' with owner '%s' and id '%s' in Kanboard",
+      project_title, project_owner['name'], new_project_id)
 
   # Get all columns in board
   project_columns = kb.get_columns(
@@ -214,8 +303,8 @@ def create_project(
 
   # Throw an error if we got no list
   if not project_columns:
-    logging.error("Could not get project columns in project '{}' (ID: {})"
-      .format(project_title, new_project_id))
+    logging.error("Could not get project columns in project '%s' (ID: %s)",
+      project_title, new_project_id)
   else:
     pass
     # FIXME: Should we abort here?
@@ -226,18 +315,18 @@ def create_project(
 
 
   # Add all users as members of the board
-  for u in project_data.get('users', []):
+  for u in ([] if project_id else project_data.get('users', [])):
     
     # Ignore user if not a Kanboard user
     if u['name'] not in users_by_username:
-      logging.error("User '{}' is not a Kanboard user in project '{}'"
-        .format(u['name'], project_title))
+      logging.error("User '%s' is not a Kanboard user in project '%s'",
+        u['name'], project_title)
       continue
     
     # Ignore user if role is invalid
     if u['role'] not in KANBOARD_ROLES:
-      logging.error("User '{}' has invalid role '{}' in project '{}'"
-        .format(u['name'], u['role'], project_title))
+      logging.error("User '%s' has invalid role '%s' in project '%s'",
+        u['name'], u['role'], project_title)
       continue
 
     # Add users to project
@@ -249,11 +338,13 @@ def create_project(
     
     # Log result
     if r:
-      logging.info("Added user '{}' with role '{}'to Kanboard project '{}'"
-      .format(u['name'], u['role'], project_title))
+      rollup.count('users_added')
+      logging.debug("Added user '%s' with role '%s'to Kanboard project '%s'",
+        u['name'], u['role'], project_title)
     else:
-      logging.error("Could not add user '{}' with role '{}'to Kanboard project '{}'"
-        .format(u['name'], u['role'], project_title))
+      rollup.count('errors')
+      logging.error("Could not add user '%s' with role '%s'to Kanboard project '%s'",
+        u['name'], u['role'], project_title)
 
   # Get users who can be assigned task in the project
   assignable_users_by_id = kb.get_assignable_users(
@@ -262,45 +353,62 @@ def create_project(
 
   # Error and empty dist if we failed getting the assignable users
   if not assignable_users_by_id:
-    logging.error("Could not get assignable users in project '{}'"
-      .format(project_title))
+    logging.error("Could not get assignable users in project '%s'", project_title)
       
     # We have no assignable users, so fall back to empty dict
     assignable_users_by_id = {}
   
+  # Create the global tags of the tasks to create up front, once each.
+  # Tasks copied from the golden project keep its tags.
+  if not golden:
+    tag_index.ensure(set([
+      tag
+      for task_template_id, t in zip(task_template_ids, project_data['tasks'])
+      if (only_template_tasks is None or task_template_id in only_template_tasks)
+      and task_matches_keys(t, keys)
+      for tag in t.get('tags', [])
+      ]))
+
+  # The groups owning tasks, with their members. Only groups used by the
+  # tasks to create are fetched.
+  if all_tasks_owner:
+    groups_by_name = {}
+  else:
+    groups_by_name = group_index.groups([
+      roles.get(t['owner'].upper(), t['owner'])
+      if 'ROLE_' in t['owner'].upper() else t['owner']
+      for task_template_id, t in zip(task_template_ids, project_data['tasks'])
+      if (only_template_tasks is None or task_template_id in only_template_tasks)
+      and task_matches_keys(t, keys) and t['owner']
+      ])
+
+  # Tasks are planned here and copied from the golden project later
+  if golden:
+    planned_tasks = []
+
   ################
   # Create tasks #
   ################
-  for t in project_data['tasks']:
-    
-    # Abort if task has no title
-    if not t.get('title'):
-      logging.error("Can not create task in project '{}' because of missing title"
-        .format(new_project_id))
-      continue
+  for task_index, t in enumerate(project_data['tasks']):
 
+    # The stable id of the task in the JSON file
+    task_template_id = task_template_ids[task_index]
 
-    # Process keys (if any in JSON)
-    if t.get('keys', None):
+    # Only create the requested tasks
+    if only_template_tasks is not None and \
+      task_template_id not in only_template_tasks:
+      continue
+    
+    # The template is shared, so changes are made to a copy of the task
+    t = copy.deepcopy(t)
 
-      # JSON keys to lower case set
-      t['keys'] = set([ k.lower() for k in t['keys'] ])
+    # Abort if 'we' do not match ALL keys in JSON to create the task
+    if not task_matches_keys(t, keys):
+      logging.debug("Not creating task '%s' in project '%s' because of missing key",
+        t['title'], project_title)
       
-      # request keys to lower case set
-      keys = set([ k.lower() for k in keys ])
-
-      # Get set of matching keys
-      matching_keys = set.intersection(t['keys'], keys)
-
-
-      # Abort if matching keys are not equal to 'our' keys
-      # That is, 'we' must match ALL keys in JSON to create the task 
-      if matching_keys != keys:
-        logging.debug("Not creating task '{}' in project '{}' because of missing key"
-          .format(t['title'], project_title))
-        
-        # Abort this iteration of the task loop
-        continue
+      # Abort this iteration of the task loop
+      continue
 
     # Assume no owner
     task_owner = None
@@ -313,14 +421,13 @@ def create_project(
       
       # Check for the existance of the role
       if role_name not in roles.keys():
-        logging.warning("Role '{}' unknown in project '{}'"
-          .format(role_name, project_title))
+        logging.warning("Role '%s' unknown in project '%s'", role_name, project_title)
       
       else:
         # Set the user name based on the role
         t['owner'] = roles.get(role_name, None)
-        logging.info("Mapping role '{}' to task owner '{}' in project '{}'"
-          .format(role_name, t['owner'], project_title))
+        logging.info("Mapping role '%s' to task owner '%s' in project '%s'",
+          role_name, t['owner'], project_title)
 
 
     # Get owner of all tasks if parsed to this function
@@ -331,7 +438,7 @@ def create_project(
     # If an owner is specified in JSON
     elif t.get('owner', None):
       
-      # If the owner is a group name, we will pick a random member
+      # If the owner is a group name, we will pick the least loaded member
       
       # Try to get a group with the name of the task owner
       group = groups_by_name.get(t['owner'], None)
@@ -339,8 +446,8 @@ def create_project(
       # If we have a group with members
       if group and len(group['members']) > 0:
         
-        # Set random group member as task_owner
-        task_owner = random.choice(group['members'])
+        # Set group member with fewest open tasks as task_owner
+        task_owner = workload.least_loaded(group['members'])
 
       else:  
         # Get matching Kanboard user if not a group
@@ -352,8 +459,7 @@ def create_project(
       
       # Log if there was no matching user
       if not task_owner:
-        logging.warning("Task owner '{}' from JSON is not a Kanboard user."
-          .format(t['owner']))
+        logging.warning("Task owner '%s' from JSON is not a Kanboard user.", t['owner'])
       else:
 
         # If the task owner is not in the Kanboard project
@@ -367,11 +473,13 @@ def create_project(
             )
         
           if r:
-            logging.info("Adding user '{}' to project '{}'"
-              .format(task_owner['name'], project_title))
+            rollup.count('users_added')
+            logging.debug("Adding user '%s' to project '%s'",
+              task_owner['name'], project_title)
           else:
-            logging.error("Could not add user '{}' to project '{}'"
-              .format(task_owner['name'], project_title))
+            rollup.count('errors')
+            logging.error("Could not add user '%s' to project '%s'",
+              task_owner['name'], project_title)
 
           # Update list of users who can be assigned tasks in the project
           assignable_users_by_id = kb.get_assignable_users(
@@ -388,8 +496,8 @@ def create_project(
     # If the task owner is not an assignable user in the project,
     # Fall back to project owner
     if task_owner['id'] not in assignable_users_by_id:
-      logging.error("Task owner '{}' is not an assignable user in project '{}'"
-        .format(task_owner['name'], project_title))
+      logging.error("Task owner '%s' is not an assignable user in project '%s'",
+        task_owner['name'], project_title)
 
       # Project owner will be the task owner
       task_owner = project_owner
@@ -403,17 +511,20 @@ def create_project(
       
       # Log results and update assignable users
       if r:
-        logging.warning("Added project owner '{}' as '{}' in project '{}'"
-          .format(task_owner['name'], 'project-manager', project_title))
+        logging.warning("Added project owner '%s' as '%s' in project '%s'",
+          task_owner['name'], 'project-manager', project_title)
 
         # Update list of assignable users in the project
         assignable_users_by_id = kb.get_assignable_users(
           project_id = new_project_id
           )
       else:
-        logging.error("Could not add project owner '{}' as '{}' in project '{}'"
-          .format(task_owner['name'], 'project-manager', project_title))
+        logging.error("Could not add project owner '%s' as '%s' in project '%s'",
+          task_owner['name'], 'project-manager', project_title)
+
 
+    # Count the task in the owners workload
+    workload.assign(task_owner)
 
     # Set task due date
     if due_date:
@@ -423,10 +534,10 @@ def create_project(
 
       try:
         # Modify due date based on JSON data
-        task_due_date += datetime.timedelta(days=int(t.get('due_date', 0)))
+        task_due_date += datetime.timedelta(days=int(t.get('due_date') or 0))
       except:
-        logging.error("Could not modify due date with value '{}' from JSON in project '{}'"
-          .format(t['due_date'], project_title))
+        logging.error("Could not modify due date with value '%s' from JSON in project '%s'",
+          t['due_date'], project_title)
 
       # Update projects latest due date
       if latest_due_date < task_due_date:
@@ -447,12 +558,19 @@ def create_project(
     ###############
     
     # Task collumn. Fallback to 1 (Leftmost)
-    task_col = project_columns_by_position.get(t.get('column', '1'), '1')
+    task_col = project_columns_by_position.get(str(t.get('column', '1')),
+      project_columns_by_position.get('1'))
 
     # Update task title and description from placeholders
     t['title'] = process_placeholders(t.get('title',''), placeholders)
     t['description'] = process_placeholders(t.get('description',''), placeholders)
 
+    # Copy the task from the golden project later
+    if golden:
+      planned_tasks.append((golden_tasks.get(task_index), t, task_owner,
+        task_due_date, task_col, task_template_id))
+      continue
+
     # Creat the task
     new_task_id = kb.create_task(
       project_id = new_project_id,
@@ -467,13 +585,21 @@ def create_project(
       )
 
     if new_task_id:
-      logging.info("Created task '{}' with owner '{}' in project '{}' with id '{}'."
-        .format(t['title'], task_owner['name'], project_title, new_project_id))
+      rollup.count('tasks_created')
+      logging.debug("Created task '%s' with owner '%s' in project '%s' with id '%s'.",
+        t['title'], task_owner['name'], project_title, new_project_id)
     else:
-      logging.error("Could not create task '{}' with owner '{}' in project '{}' with id '{}'."
-        .format(t['title'], task_owner['name'], project_title, new_project_id))
+      rollup.count('errors')
+      logging.error("Could not create task '%s' with owner '%s' in project '%s' with id '%s'.",
+        t['title'], task_owner['name'], project_title, new_project_id)
       # Abort this iteration
       continue
+
+    # Tag the task with its template task id
+    metadata_calls.append(('save_task_metadata', {
+      'task_id': new_task_id,
+      'values': {'template_task': task_template_id}
+      }))
     
     #############
     # Add links #
@@ -493,11 +619,13 @@ def create_project(
         url = l.get('url', None),
         )
       if r:
-        logging.info("Added link '{}' to task '{}' in project '{}'"
-          .format(l.get('title', None), t['title'], project_title))
+        rollup.count('links_created')
+        logging.debug("Added link '%s' to task '%s' in project '%s'",
+          l.get('title', None), t['title'], project_title)
       else:
-        logging.error("Could not add link '{}' to task '{}' in project '{}'"
-          .format(l.get('title', None), t['title'], project_title))
+        rollup.count('errors')
+        logging.error("Could not add link '%s' to task '%s' in project '%s'",
+          l.get('title', None), t['title'], project_title)
 
     ################
     # Add subtasks #
@@ -517,15 +645,40 @@ def create_project(
       
       # Log the results
       if r:
-        logging.info("Created subtask '{}' in project '{}'"
-          .format(st['title'], project_title))
+        rollup.count('subtasks_created')
+        logging.debug("Created subtask '%s' in project '%s'", st['title'], project_title)
       else:
-        logging.error("Could not create subtask '{}' in project '{}'"
-          .format(st['title'], project_title))
+        rollup.count('errors')
+        logging.error("Could not create subtask '%s' in project '%s'",
+          st['title'], project_title)
+
+  # Copy the planned tasks from the golden project
+  if golden:
+    metadata_calls += copy_golden_tasks(
+      kb, new_project_id, project_title, planned_tasks, placeholders, rollup)
+
+  # Tag the tasks and the project with the template they came from
+  metadata_calls.append(('save_project_metadata', {
+    'project_id': new_project_id,
+    'values': {
+      'template_checksum': checksum,
+      'due_date': due_date.isoformat() if due_date else ''
+      }
+    }))
+  kanboard_client.execute_batch(kb, metadata_calls)
 
   # FIXME: Update project due date
   #r = kb.update_project(latest_due_date:
 
+  # One record for the whole project
+  rollup.emit(
+    project = project_title,
+    project_id = new_project_id,
+    status = 'updated' if project_id else 'created'
+    )
+
+  return new_project_id
+
 def process_placeholders(string_to_process, placeholders):
   '''
   Replaces all occurences of keys from dict 'placeholders'
@@ -538,3 +691,701 @@ def process_placeholders(string_to_process, placeholders):
     string_to_process = string_to_process.replace(key, str(value))
 
   return string_to_process
+
+def task_matches_keys(t, keys):
+  '''
+  Returns True if the task t from a JSON file has no keys, or if ALL
+  keys in list 'keys' are in the keys of the task. Keys are case insensitive.
+  '''
+  if not t.get('keys', None):
+    return True
+
+  return set([ k.lower() for k in keys ]) <= set([ k.lower() for k in t['keys'] ])
+
+def reconcile_project(
+    project_file,
+    kb,
+    project_id,
+    project_owner = None,
+    task_owner = None,
+    due_date = None,
+    roles = {},
+    placeholders = {},
+    keys = [],
+    workload = None,
+    tag_index = None,
+    group_index = None
+    ):
+  '''
+  Applies changes in the JSON file project_file to the existing project
+  with id project_id, created by create_project() from the same file.
+
+  Tasks are matched by their template task id (Task metadata
+  'template_task'. See match_tasks()). Changed titles, descriptions, colors and due dates
+  are updated, subtasks are added or removed (Matched by title), tasks
+  added to the file are created and open tasks removed from the file
+  (Or no longer matching the keys) are removed. Columns, owners and the
+  status of tasks and subtasks are kept, so progress is not lost.
+  Requests are sent in JSON-RPC batches.
+
+  The other arguments are as for create_project().
+
+  Returns True if the project was reconciled.
+  '''
+
+  # Make sure all placeholder values are strings
+  for k in placeholders.keys():
+    placeholders[k] = str(placeholders[k])
+
+  # Load and check the project data from the JSON file
+  try:
+    template = project_template.check(project_file)
+  except project_template.TemplateError as e:
+    logging.error("%s. Not reconciling project '%s'.", e, project_id)
+    return False
+
+  checksum = template.checksum
+
+  # The tasks which should be in the project by template task id
+  wanted_tasks = {
+    task_template_id: t
+    for task_template_id, t in zip(template.task_ids, template.data['tasks'])
+    if task_matches_keys(t, keys)
+    }
+
+  # All open and closed tasks in the project
+  task_lists = kanboard_client.execute_batch(kb, [
+    ('get_all_tasks', {'project_id': project_id, 'status_id': 1}),
+    ('get_all_tasks', {'project_id': project_id, 'status_id': 0})
+    ])
+
+  # Without all tasks, tasks in the project would be taken as missing
+  if None in task_lists:
+    logging.error("Could not get the tasks of project '%s'. Not reconciling.", project_id)
+    return False
+
+  tasks = [t for task_list in task_lists for t in task_list]
+
+  # The template task id of all tasks. Empty if the task is not tagged.
+  task_template_ids = kanboard_client.execute_batch(kb, [
+    ('get_task_metadata_by_name', {'task_id': t['id'], 'name': 'template_task'})
+    for t in tasks
+    ])
+
+  # Without all tags, tagged tasks would be taken as untagged
+  if None in task_template_ids:
+    logging.error("Could not get the template tasks of project '%s'. Not reconciling.",
+      project_id)
+    return False
+
+  # Tasks created from the template by template task id
+  tasks_by_template_id = {
+    task_template_id: t
+    for t, task_template_id in zip(tasks, task_template_ids)
+    if task_template_id
+    }
+
+  # Projects created before tasks were tagged can not be reconciled.
+  # Marked, so they are not fetched again every run.
+  if tasks and not tasks_by_template_id:
+    logging.warning("No tasks tagged with a template task in project '%s'. Not reconciling.",
+      project_id)
+    kb.save_project_metadata(
+      project_id = project_id,
+      values = {'template_checksum': checksum, 'reconcile': 'untagged'}
+      )
+    return False
+
+  # Match the tasks of the project with the tasks of the template
+  added, removed, matched, retagged = match_tasks(
+    wanted_tasks,
+    tasks_by_template_id,
+    dict(zip(template.legacy_task_ids, template.task_ids)),
+    placeholders
+    )
+
+  calls = []
+
+  # Update the fields changed in the template
+  for i, task in matched:
+    t = wanted_tasks[i]
+    changes = {}
+
+    title = process_placeholders(t.get('title', ''), placeholders)
+    if title != task['title']:
+      changes['title'] = title
+
+    description = process_placeholders(t.get('description', ''), placeholders)
+    if description != (task.get('description') or ''):
+      changes['description'] = description
+
+    if t.get('color') and t['color'] != task.get('color_id'):
+      changes['color_id'] = t['color']
+
+    if due_date:
+      try:
+        task_due_date = due_date + datetime.timedelta(days=int(t.get('due_date') or 0))
+      except (TypeError, ValueError):
+        task_due_date = due_date
+
+      # Kanboard has the due date as a timestamp. 0 if no due date.
+      current_due_date = int(task.get('date_due') or 0)
+      if not current_due_date or \
+        datetime.date.fromtimestamp(current_due_date) != task_due_date:
+        changes['date_due'] = task_due_date.strftime('%Y-%m-%d')
+
+    if changes:
+      logging.info("Updating %s in task '%s' in project '%s'",
+        ', '.join(sorted(changes)), task['title'], project_id)
+      changes['id'] = task['id']
+      calls.append(('update_task', changes))
+
+  # Number of tasks updated
+  updated = len(calls)
+
+  # Tag tasks matched by their old id or title with their template task id
+  for i, task in retagged:
+    logging.info("Task '%s' in project '%s' is now template task '%s'",
+      task['title'], project_id, i)
+    calls.append(('save_task_metadata', {
+      'task_id': task['id'],
+      'values': {'template_task': i}
+      }))
+
+  # Remove tasks removed from the template
+  for task in removed:
+    logging.info("Removing task '%s' from project '%s'", task['title'], project_id)
+    calls.append(('remove_task', {'task_id': task['id']}))
+
+  # Get the subtasks of the matched tasks in the same batch
+  results = kanboard_client.execute_batch(kb, calls + [
+    ('get_all_subtasks', {'task_id': task['id']}) for _, task in matched
+    ])
+  subtask_lists = results[len(calls):]
+
+  # Add and remove subtasks. Subtasks are matched by title.
+  subtask_calls = []
+  for (i, task), subtasks in zip(matched, subtask_lists):
+
+    wanted_titles = collections.Counter(
+      process_placeholders(st.get('title', ''), placeholders)
+      for st in wanted_tasks[i].get('subtasks', [])
+      )
+
+    for st in (subtasks or []):
+      if wanted_titles[st['title']] > 0:
+        wanted_titles[st['title']] -= 1
+      else:
+        subtask_calls.append(('remove_subtask', {'subtask_id': st['id']}))
+
+    for title, n in wanted_titles.items():
+      subtask_calls += [
+        ('create_subtask', {'task_id': task['id'], 'title': title})
+        ] * n
+
+  kanboard_client.execute_batch(kb, subtask_calls)
+
+  # Create tasks added to the template. Also saves the new checksum.
+  if added:
+    create_project(
+      project_file,
+      kb,
+      project_owner = project_owner,
+      task_owner = task_owner,
+      due_date = due_date,
+      roles = roles,
+      placeholders = placeholders,
+      keys = keys,
+      workload = workload,
+      project_id = project_id,
+      only_template_tasks = set(added),
+      tag_index = tag_index,
+      group_index = group_index
+      )
+  else:
+    kb.save_project_metadata(
+      project_id = project_id,
+      values = {'template_checksum': checksum}
+      )
+
+  logging.info("Reconciled project '%s': %s tasks updated, %s retagged, %s added, %s removed, %s subtask changes",
+    project_id,
+    updated,
+    len(retagged),
+    len(added),
+    len(removed),
+    len(subtask_calls))
+
+  return True
+
+
+def match_tasks(wanted_tasks, tasks_by_template_id, template_ids_by_legacy_id,
+  placeholders = {}):
+  '''
+  Matches the tasks of a project with the tasks of its template.
+
+  Tasks tagged with a template task id no longer in the template are
+  matched by the id they had before tasks had ids (See
+  project_template.legacy_task_ids()), or else by title, before they are
+  taken as removed. So a task is only removed when it is gone from the
+  template, never because its id changed.
+
+  wanted_tasks: The tasks from the template which should be in the
+  project, by template task id. In template order.
+
+  tasks_by_template_id: The Kanboard tasks of the project by the template
+  task id they are tagged with
+
+  template_ids_by_legacy_id: Template task id by legacy task id
+
+  placeholders: The placeholders of the project, for matching titles
+
+  Returns tuple (added, removed, matched, retagged): List of template task
+  ids to create, list of open Kanboard tasks to remove, list of (template
+  task id, Kanboard task) tuples for all matched tasks, and the list of
+  those tuples whose tasks must be tagged with a new template task id.
+  '''
+  matched = [
+    (i, task) for i, task in tasks_by_template_id.items() if i in wanted_tasks
+    ]
+
+  # Template tasks not in the project yet
+  unclaimed = set(wanted_tasks) - set([i for i, _ in matched])
+
+  removed = []
+  retagged = []
+
+  for old_id, task in tasks_by_template_id.items():
+    if old_id in wanted_tasks:
+      continue
+
+    # The legacy id of the task, or else a template task with its title
+    new_id = template_ids_by_legacy_id.get(old_id)
+    if new_id not in unclaimed:
+      new_id = None
+      for i in wanted_tasks:
+        if i in unclaimed and \
+          process_placeholders(wanted_tasks[i].get('title', ''), placeholders) == task['title']:
+          new_id = i
+          break
+
+    if new_id:
+      unclaimed.remove(new_id)
+      matched.append((new_id, task))
+      retagged.append((new_id, task))
+
+    # Closed tasks are kept
+    elif int(task.get('is_active', 1)) == 1:
+      removed.append(task)
+
+  added = [i for i in wanted_tasks if i in unclaimed]
+
+  return (added, removed, matched, retagged)
+
+
+class WorkloadIndex:
+  '''
+  Number of open tasks by Kanboard user id.
+
+  The index is built on first use from the open tasks of all active
+  projects, fetched in one JSON-RPC batch, and then updated as tasks are
+  assigned. Picking the least loaded user costs no further requests.
+
+  kb: The Kanboard instance to use
+
+  projects: List of all Kanboard projects, if already fetched
+  '''
+
+  def __init__(self, kb, projects = None):
+    self.kb = kb
+    self.projects = projects
+    self.open_tasks_by_user_id = None
+
+    # The index is shared by projects created in parallel
+    self.lock = threading.Lock()
+
+  def build(self):
+    '''
+    Counts the open tasks of all users
+    '''
+    if self.projects is None:
+      self.projects = self.kb.get_all_projects()
+
+    # Open tasks of all active projects in one batch
+    task_lists = kanboard_client.execute_batch(self.kb, [
+      ('get_all_tasks', {'project_id': p['id'], 'status_id': 1})
+      for p in self.projects if int(p.get('is_active', 1)) == 1
+      ])
+
+    self.open_tasks_by_user_id = collections.Counter(
+      str(t['owner_id'])
+      for tasks in task_lists for t in (tasks or [])
+      if int(t.get('owner_id') or 0)
+      )
+
+    logging.info("Counted open tasks of %s users in %s projects",
+      len(self.open_tasks_by_user_id), len(task_lists))
+
+  def least_loaded(self, users):
+    '''
+    Returns the user (dict) with fewest open tasks from list users.
+    Ties are broken by username.
+    '''
+    with self.lock:
+      if self.open_tasks_by_user_id is None:
+        self.build()
+
+      return min(users, key = lambda u: (
+        self.open_tasks_by_user_id[str(u['id'])], u['username']))
+
+  def assign(self, user):
+    '''
+    Counts a new open task for user (dict)
+    '''
+    # Tasks assigned before the index is built are counted when built
+    with self.lock:
+      if self.open_tasks_by_user_id is None or not user.get('id'):
+        return
+
+      self.open_tasks_by_user_id[str(user['id'])] += 1
+
+
+class GroupIndex:
+  '''
+  Kanboard groups with their members by group name.
+
+  The groups are listed on first use, and the members of a group are
+  only fetched when a task owned by the group is created, once per
+  group. Members of several groups are fetched in one JSON-RPC batch.
+
+  kb: The Kanboard instance to use
+  '''
+
+  def __init__(self, kb):
+    self.kb = kb
+
+    # All groups by name. None until listed.
+    self.groups_by_name = None
+
+    # The index is shared by projects created in parallel
+    self.lock = threading.Lock()
+
+  def groups(self, names):
+    '''
+    Returns dict of groups (dict with the list of users in 'members')
+    by name, for the names in names that are groups
+    '''
+    with self.lock:
+
+      if self.groups_by_name is None:
+        self.groups_by_name = {g['name']: g for g in self.kb.get_all_groups() or []}
+
+      groups = [
+        self.groups_by_name[n] for n in set(names) if n in self.groups_by_name
+        ]
+
+      # Fetch the members of the groups not fetched yet in one batch
+      missing = [g for g in groups if 'members' not in g]
+
+      members = kanboard_client.execute_batch(self.kb, [
+        ('get_group_members', {'group_id': g['id']}) for g in missing
+        ])
+
+      for g, m in zip(missing, members):
+        g['members'] = m or []
+
+      return {g['name']: g for g in groups}
+
+
+class TagIndex:
+  '''
+  Global tags (Project id 0) by name.
+
+  Tasks are created with the names of their tags. Kanboard uses a global
+  tag with the name if there is one, and else creates the tag in the
+  project, once per project. With global tags, the tags of the tasks are
+  made to exist up front instead, with one lookup per run and one batch
+  of creations for the tags not known yet, so the tasks of all projects
+  share them.
+
+  kb: The Kanboard instance to use
+
+  global_tags: If True, tags are created as global tags. Global tags show
+  up in every project. If False (The default), nothing is done and
+  Kanboard creates the tags in each project.
+  '''
+
+  def __init__(self, kb, global_tags = False):
+    self.kb = kb
+    self.global_tags = global_tags
+
+    # Global tag ids by lowercase name. Kanboard matches tag names case
+    # insensitively. None until looked up.
+    self.tag_ids = None
+
+    # The index is shared by projects created in parallel
+    self.lock = threading.Lock()
+
+  def ensure(self, names):
+    '''
+    Makes sure global tags with names in names exist, if global tags
+    are used
+    '''
+    if not self.global_tags or not names:
+      return
+
+    with self.lock:
+
+      # Look up the existing tags once
+      if self.tag_ids is None:
+        self.tag_ids = {
+          tag['name'].lower(): tag['id']
+          for tag in self.kb.get_tags_by_project(project_id = 0) or []
+          }
+
+      # Create the missing tags in one batch
+      missing = {}
+      for n in sorted(names):
+        if n.lower() not in self.tag_ids:
+          missing.setdefault(n.lower(), n)
+      missing = list(missing.values())
+
+      tag_ids = kanboard_client.execute_batch(self.kb, [
+        ('create_tag', {'project_id': 0, 'tag': name}) for name in missing
+        ])
+
+      for name, tag_id in zip(missing, tag_ids):
+        if tag_id:
+          logging.debug("Created global tag '%s'", name)
+          self.tag_ids[name.lower()] = tag_id
+
+
+def golden_project(project_file, kb, owner_id, template = None):
+  '''
+  Returns a dict of task ids by task index in the tasks of project_file
+  in the "golden" Kanboard project for the template project_file, or
+  None if the golden project could not be built.
+
+  The golden project holds all tasks and subtasks of the template with
+  placeholders and without owners and due dates. It is disabled, so it
+  stays hidden. If the JSON file changed since the golden project was
+  built (Checksum in the project description), it is built again.
+  Results are cached by checksum, so a changed template is looked up again.
+
+  owner_id: The Kanboard user id of the owner of the golden project
+
+  template: The project_template.Template of project_file. If not set,
+  the file is loaded. Pass the template the tasks are planned from, so
+  the task indexes are of the same version of the file.
+  '''
+  if template is None:
+    template = project_template.check(project_file)
+
+  with _golden_lock:
+    return _golden_project(project_file, kb, owner_id, template)
+
+
+def _golden_project(project_file, kb, owner_id, template):
+  '''
+  Does the work of golden_project(). Must be called with _golden_lock held.
+  '''
+  # The checksum of the template tells if the golden project is outdated
+  checksum = template.checksum
+
+  if (project_file, checksum) in _golden_tasks_by_template:
+    return _golden_tasks_by_template[(project_file, checksum)]
+  project_data = template.data
+
+  # Identifier of the golden project for this template
+  identifier = 'GOLDEN' + hashlib.sha1(
+    os.path.basename(project_file).encode()).hexdigest()[:10].upper()
+
+  description = "Golden project for '{}'. Checksum: {}".format(
+    os.path.basename(project_file), checksum)
+
+  project = kb.get_project_by_identifier(identifier = identifier)
+
+  # Use existing golden project if template is unchanged
+  if project and checksum in (project.get('description') or ''):
+    tasks = kb.get_all_tasks(project_id = project['id'], status_id = 1)
+    golden_tasks = {
+      int(t['reference'][len('TEMPLATE'):]): t['id']
+      for t in tasks if (t.get('reference') or '').startswith('TEMPLATE')
+      }
+    _golden_tasks_by_template[(project_file, checksum)] = golden_tasks
+    return golden_tasks
+
+  # Remove outdated golden project
+  if project:
+    logging.info("Template '%s' changed. Rebuilding golden project.", project_file)
+    kb.remove_project(project_id = project['id'])
+
+  project_id = kb.create_project(
+    name = "Template: {}".format(project_data.get('title', project_file)),
+    description = description,
+    owner_id = owner_id,
+    identifier = identifier
+    )
+
+  if not project_id:
+    logging.error("Could not create golden project for '%s'", project_file)
+    return None
+
+  columns_by_position = {
+    c['position']: c for c in kb.get_columns(project_id = project_id)
+    }
+
+  # Create all tasks. The reference is the tasks index in the template.
+  task_ids = kanboard_client.execute_batch(kb, [
+    ('create_task', {
+      'project_id': project_id,
+      'title': t.get('title', ''),
+      'description': t.get('description', ''),
+      'color_id': t.get('color', ''),
+      'tags': t.get('tags', []),
+      'reference': 'TEMPLATE{}'.format(i),
+      'column_id': columns_by_position.get(
+        str(t.get('column', '1')), columns_by_position.get('1', {})).get('id')
+      })
+    for i, t in enumerate(project_data['tasks'])
+    ])
+
+  # An incomplete golden project would give incomplete projects. Built
+  # again next time.
+  if not all(task_ids):
+    logging.error("Could not create all tasks of golden project for '%s'", project_file)
+    kb.remove_project(project_id = project_id)
+    return None
+
+  # Create all subtasks
+  kanboard_client.execute_batch(kb, [
+    ('create_subtask', {'task_id': task_id, 'title': st.get('title', '')})
+    for t, task_id in zip(project_data['tasks'], task_ids) if task_id
+    for st in t.get('subtasks', [])
+    ])
+
+  # Hide the golden project
+  kb.disable_project(project_id = project_id)
+
+  logging.info("Created golden project '%s' for '%s'", identifier, project_file)
+
+  golden_tasks = {
+    i: task_id for i, task_id in enumerate(task_ids) if task_id
+    }
+  _golden_tasks_by_template[(project_file, checksum)] = golden_tasks
+
+  return golden_tasks
+
+
+def copy_golden_tasks(kb, project_id, project_title, planned_tasks, placeholders,
+  rollup = None):
+  '''
+  Copies tasks from a golden project to the project with id project_id,
+  and updates the per project fields (Titles, owners, due dates, links
+  and subtask titles with placeholders) in JSON-RPC batches.
+
+  planned_tasks: List of tuples (golden task id, task from JSON,
+  task owner, task due date, task column, template task id)
+
+  rollup: An eventlog.Rollup counting what is created
+
+  Returns list of calls tagging the new tasks with their template task id
+  '''
+  if rollup is None:
+    rollup = eventlog.Rollup('golden_copy', project_id = project_id)
+
+  # Tasks missing in the golden project can not be copied
+  for golden_task_id, t, _, _, _, _ in planned_tasks:
+    if not golden_task_id:
+      logging.error("Task '%s' is not in the golden project. Not created in project '%s'",
+        t['title'], project_title)
+  planned_tasks = [p for p in planned_tasks if p[0]]
+
+  # Copy all tasks in one batch
+  new_task_ids = kanboard_client.execute_batch(kb, [
+    ('duplicate_task_to_project', {
+      'task_id': golden_task_id,
+      'project_id': project_id,
+      'column_id': task_col['id'],
+      'owner_id': task_owner.get('id', '')
+      })
+    for golden_task_id, t, task_owner, _, task_col, _ in planned_tasks
+    ])
+
+  # Update fields, add links and get subtasks with placeholders
+  calls = []
+  tasks_with_placeholder_subtasks = []
+  metadata_calls = []
+
+  for (_, t, task_owner, task_due_date, _, task_template_id), new_task_id in \
+    zip(planned_tasks, new_task_ids):
+
+    if not new_task_id:
+      rollup.count('errors')
+      logging.error("Could not create task '%s' with owner '%s' in project '%s' with id '%s'.",
+        t['title'], task_owner['name'], project_title, project_id)
+      continue
+
+    rollup.count('tasks_created')
+    logging.debug("Created task '%s' with owner '%s' in project '%s' with id '%s'.",
+      t['title'], task_owner['name'], project_title, project_id)
+
+    metadata_calls.append(('save_task_metadata', {
+      'task_id': new_task_id,
+      'values': {'template_task': task_template_id}
+      }))
+
+    calls.append(('update_task', {
+      'id': new_task_id,
+      'title': t['title'],
+      'description': t['description'],
+      'date_due': task_due_date
+      }))
+
+    for l in t.get('links', []):
+      calls.append(('create_external_task_link', {
+        'task_id': new_task_id,
+        'dependency': 'related',
+        'type': 'weblink',
+        'title': l.get('title', None),
+        'url': l.get('url', None)
+        }))
+
+    # Only subtasks with placeholders must be updated
+    if any(
+      process_placeholders(st.get('title', ''), placeholders) != st.get('title', '')
+      for st in t.get('subtasks', [])
+      ):
+      tasks_with_placeholder_subtasks.append(new_task_id)
+      calls.append(('get_all_subtasks', {'task_id': new_task_id}))
+
+  results = kanboard_client.execute_batch(kb, calls)
+
+  # Log failed updates
+  for (method, params), result in zip(calls, results):
+    if method == 'create_external_task_link' and result:
+      rollup.count('links_created')
+    if not result:
+      rollup.count('errors')
+      logging.error("Call '%s' failed for task '%s' in project '%s'",
+        method, params.get('id', params.get('task_id')), project_title)
+
+  # Update subtasks with placeholders
+  subtask_lists = [
+    result for (method, _), result in zip(calls, results)
+    if method == 'get_all_subtasks'
+    ]
+
+  subtask_results = kanboard_client.execute_batch(kb, [
+    ('update_subtask', {
+      'id': st['id'],
+      'task_id': task_id,
+      'title': process_placeholders(st['title'], placeholders)
+      })
+    for task_id, subtasks in zip(tasks_with_placeholder_subtasks, subtask_lists)
+    for st in (subtasks or [])
+    if process_placeholders(st['title'], placeholders) != st['title']
+    ])
+  rollup.count('subtasks_updated', subtask_results.count(True))
+
+  return metadata_calls
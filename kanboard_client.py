@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import base64
+import collections
+import contextlib
+import gzip
+import http.client
+import json
+import logging
+import queue
+import select
+import ssl
+import threading
+import time
+import urllib.parse
+
+import kanboard
+
+
+# Max number of calls in one JSON-RPC batch request
+BATCH_SIZE = 100
+
+# Fields never written to a recording (See Recorder). A field is secret if
+# its name contains any of these (e.g. 'api_access_token').
+SECRET_FIELDS = ('password', 'token', 'secret')
+
+
+class Client(kanboard.Client):
+  '''
+  Kanboard API client with support for JSON-RPC batch requests.
+
+  Requests are sent over a pool of keep-alive connections, so the TCP and
+  TLS handshakes are only paid once per connection, and gzip compressed
+  responses are accepted, which shrinks large results like getAllUsers.
+
+  Takes the same arguments as kanboard.Client, and:
+
+  pool_size: Max number of idle connections kept open
+
+  connect_timeout: Seconds to wait for a connection. If not set, the
+  timeout of kanboard.Client is used.
+
+  read_timeout: Seconds to wait for a response. If not set, the timeout
+  of kanboard.Client is used.
+
+  compress: If True, ask for gzip compressed responses
+
+  profiler: If set, the time of every request is recorded by API method
+  (See profiling.Profiler)
+
+  recorder: If set, every request and response is written to a
+  recording (See Recorder)
+  '''
+
+  def __init__(self, *args, pool_size = 4, connect_timeout = None,
+    read_timeout = None, compress = True, profiler = None, recorder = None,
+    **kwargs):
+
+    super().__init__(*args, **kwargs)
+
+    self.profiler = profiler
+    self.recorder = recorder
+
+    self._pool_size = pool_size
+    self._connect_timeout = connect_timeout or self._timeout
+    self._read_timeout = read_timeout or self._timeout
+    self._compress = compress
+
+    # Idle connections. Last used first, as it is least likely closed.
+    self._pool = queue.LifoQueue()
+
+    url = urllib.parse.urlsplit(self._url)
+    self._scheme = url.scheme
+    self._host = url.hostname
+    self._port = url.port
+    self._path = url.path or '/'
+    if url.query:
+      self._path += '?' + url.query
+
+    # The SSL context is shared by all connections
+    self._ssl_context = ssl.create_default_context(cafile = self._cafile)
+    if self._insecure:
+      self._ssl_context.check_hostname = False
+      self._ssl_context.verify_mode = ssl.CERT_NONE
+
+    if self._ignore_hostname_verification:
+      self._ssl_context.check_hostname = False
+
+  def close(self):
+    '''
+    Closes all idle connections and the event loop (If owned)
+    '''
+    while not self._pool.empty():
+      self._pool.get_nowait().close()
+
+    super().close()
+
+  def _headers(self):
+    '''
+    Returns dict with the HTTP headers of a request
+    '''
+    credentials = base64.b64encode(
+      '{}:{}'.format(self._username, self._password).encode())
+
+    if self._auth_header == kanboard.DEFAULT_AUTH_HEADER:
+      auth_header_prefix = 'Basic '
+    else:
+      auth_header_prefix = ''
+
+    return {
+      self._auth_header: auth_header_prefix + credentials.decode(),
+      'Content-Type': 'application/json',
+      'User-Agent': self._user_agent,
+      }
+
+  def _connection(self):
+    '''
+    Returns tuple (connection, reused). An idle connection from the
+    pool if any, else a new connection. Idle connections closed by the
+    server are dropped.
+    '''
+    while True:
+      try:
+        connection = self._pool.get_nowait()
+      except queue.Empty:
+        return (self._new_connection(), False)
+
+      # An idle connection is only readable if the server closed it
+      if connection.sock and not select.select([connection.sock], [], [], 0)[0]:
+        return (connection, True)
+
+      connection.close()
+
+  def _new_connection(self):
+    '''
+    Returns a new connection to Kanboard
+    '''
+    if self._scheme == 'https':
+      connection = http.client.HTTPSConnection(
+        self._host, self._port,
+        timeout = self._connect_timeout, context = self._ssl_context)
+    else:
+      connection = http.client.HTTPConnection(
+        self._host, self._port, timeout = self._connect_timeout)
+
+    # Connect now, so reads can have their own timeout
+    connection.connect()
+    connection.sock.settimeout(self._read_timeout)
+
+    return connection
+
+  def _release(self, connection):
+    '''
+    Returns a connection to the pool, or closes it if the pool is full
+    '''
+    if self._pool.qsize() < self._pool_size:
+      self._pool.put(connection)
+    else:
+      connection.close()
+
+  def _send(self, headers, body):
+    '''
+    Sends the JSON-RPC request 'body' (dict or list) to Kanboard, and
+    records it if there is a recorder.
+
+    Returns the raw (uncompressed) response (bytes)
+    '''
+    if not self.recorder:
+      return self._post(headers, body)
+
+    start = time.perf_counter()
+
+    try:
+      raw = self._post(headers, body)
+    except kanboard.ClientError as e:
+      self.recorder.record(body, None, time.perf_counter() - start, str(e))
+      raise
+
+    self.recorder.record(body, raw, time.perf_counter() - start)
+
+    return raw
+
+  def _post(self, headers, body):
+    '''
+    Posts the JSON-RPC request 'body' (dict or list) to Kanboard.
+
+    Returns the raw (uncompressed) response (bytes)
+    '''
+    headers = dict(headers)
+    if self._compress:
+      headers['Accept-Encoding'] = 'gzip'
+
+    data = json.dumps(body).encode()
+    connection = None
+
+    try:
+      connection, reused = self._connection()
+
+      try:
+        connection.request('POST', self._path, body = data, headers = headers)
+
+      # The server may have closed an idle connection. The request
+      # could not be sent, so it is safe to send it again.
+      except (BrokenPipeError, ConnectionResetError):
+        connection.close()
+        if not reused:
+          raise
+        connection = self._new_connection()
+        connection.request('POST', self._path, body = data, headers = headers)
+
+      # The request may have been handled when reading the response
+      # fails, so it is never sent again. Calls like createTask would
+      # be done twice.
+      response = connection.getresponse()
+
+      raw = response.read()
+
+      # Keep the connection for the next request
+      if not response.will_close:
+        self._release(connection)
+        connection = None
+
+      if response.status >= 400:
+        raise kanboard.ClientError(
+          'HTTP Error {}: {}'.format(response.status, response.reason))
+
+      if response.getheader('Content-Encoding') == 'gzip':
+        raw = gzip.decompress(raw)
+
+      return raw
+
+    except kanboard.ClientError:
+      raise
+
+    except Exception as e:
+      raise kanboard.ClientError(str(e)) from e
+
+    # Connections not returned to the pool are closed
+    finally:
+      if connection:
+        connection.close()
+
+  def _timer(self, name):
+    '''
+    Returns a context manager timing an API request, if profiling
+    '''
+    if not self.profiler:
+      return contextlib.nullcontext()
+
+    return self.profiler.timer('api', name)
+
+  def _do_request(self, headers, body):
+    with self._timer(body.get('method')):
+      return self._parse_response(self._send(headers, body))
+
+  def execute_batch(self, calls):
+    '''
+    Calls several remote procedures with JSON-RPC batch requests.
+
+    calls: List of (method, params) tuples. Methods are the names used
+    when calling the client (e.g. 'create_task'), params are dicts.
+
+    Returns list of results in the order of calls. A failed call gives None.
+    '''
+    results = []
+
+    for offset in range(0, len(calls), BATCH_SIZE):
+
+      # The calls in this batch with their position as id
+      payload = [
+        {
+          'jsonrpc': '2.0',
+          'id': i,
+          'method': self._to_camel_case(method),
+          'params': params
+        }
+        for i, (method, params) in enumerate(calls[offset:offset+BATCH_SIZE])
+        ]
+
+      # Batches are timed by the most frequent method in them
+      method = collections.Counter(
+        [c['method'] for c in payload]).most_common(1)[0][0]
+
+      with self._timer('batch ' + method):
+        response = self._send(self._headers(), payload)
+
+      try:
+        responses = json.loads(response.decode(errors = 'ignore'))
+      except ValueError as e:
+        raise kanboard.ClientError(
+          'Failed to parse JSON batch response: {}'.format(e)) from e
+
+      # A failing batch gives a single error object
+      if isinstance(responses, dict):
+        raise kanboard.ClientError(
+          (responses.get('error') or {}).get('message', 'Batch failed'))
+
+      # Responses may come in any order
+      responses_by_id = {r.get('id'): r for r in responses}
+
+      for i in range(len(payload)):
+        r = responses_by_id.get(i, {})
+
+        if r.get('error'):
+          logging.error("Batch call '%s' failed: %s",
+            payload[i]['method'], r['error'].get('message'))
+
+        results.append(r.get('result'))
+
+    return results
+
+
+def execute_batch(kb, calls):
+  '''
+  Calls several remote procedures on the Kanboard instance 'kb'.
+  Uses JSON-RPC batch requests if the client supports them, and one
+  request per call if not (e.g. a plain kanboard.Client).
+
+  calls: List of (method, params) tuples as in Client.execute_batch()
+
+  Returns list of results in the order of calls. A failed call gives None.
+  '''
+  if isinstance(kb, Client):
+    return kb.execute_batch(calls)
+
+  results = []
+
+  for method, params in calls:
+    try:
+      results.append(getattr(kb, method)(**params))
+    except kanboard.ClientError as e:
+      logging.error("Call '%s' failed: %s", method, e)
+      results.append(None)
+
+  return results
+
+
+def redact(value):
+  '''
+  Returns a copy of value (Decoded JSON) with the values of all fields
+  with a name containing any of SECRET_FIELDS replaced by '***'
+  '''
+  if isinstance(value, dict):
+    return {
+      k: '***' if any(s in str(k).lower() for s in SECRET_FIELDS) else redact(v)
+      for k, v in value.items()
+      }
+
+  if isinstance(value, list):
+    return [redact(v) for v in value]
+
+  return value
+
+
+class Recorder:
+  '''
+  Writes Kanboard JSON-RPC traffic to a JSONL file, one object per request:
+
+  {"time": 0.52, "seconds": 0.031, "request": {...}, "response": {...}}
+
+  time is the seconds since the recording started, and seconds is how
+  long the request took. Failed requests have "error" instead of
+  "response". Credentials are sent in headers, which are not recorded,
+  and fields in SECRET_FIELDS are redacted. The file can be served again
+  with ReplayClient.
+
+  filename: The JSONL file. It is overwritten.
+  '''
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.file = open(filename, 'w')
+    self.start = time.perf_counter()
+
+    # Requests are recorded from several threads
+    self.lock = threading.Lock()
+
+  def record(self, request, raw, seconds, error = None):
+    '''
+    Writes a request and its raw response (bytes) to the file
+    '''
+    entry = {
+      'time': round(time.perf_counter() - self.start - seconds, 6),
+      'seconds': round(seconds, 6),
+      'request': redact(request),
+      }
+
+    if error is not None:
+      entry['error'] = error
+    else:
+      try:
+        entry['response'] = redact(json.loads(raw.decode(errors = 'ignore')))
+      except ValueError:
+        entry['error'] = 'Invalid JSON response'
+
+    line = json.dumps(entry, ensure_ascii = False)
+
+    with self.lock:
+      self.file.write(line + '\n')
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+def request_key(request, params = True):
+  '''
+  Returns a key for matching a JSON-RPC request (dict or list) with a
+  recorded request. Without params, only the methods are matched.
+  '''
+  calls = request if isinstance(request, list) else [request]
+
+  return json.dumps([
+    [c.get('method'), c.get('params') if params else None] for c in calls
+    ], sort_keys = True)
+
+
+class ReplayClient(Client):
+  '''
+  Kanboard API client serving the responses in a recording made with
+  Recorder, instead of talking to Kanboard. For profiling and comparing
+  changes offline against real traffic.
+
+  A request gets the next recorded response to a request with the same
+  methods and params. If there is none (e.g. due dates computed from
+  another day), it gets the next response to a request with the same
+  methods. Requests never recorded fail with kanboard.ClientError.
+
+  filename: The JSONL file written by Recorder
+
+  pace: 'original' to take as long as the recorded requests, or 'fast'
+  to respond at once
+
+  Other arguments are as for Client. No connection is made.
+  '''
+
+  def __init__(self, filename, pace = 'fast', **kwargs):
+
+    super().__init__('http://replay/jsonrpc.php', 'replay', 'replay', **kwargs)
+
+    self.pace = pace
+
+    # Recorded entries by request with params, and by methods only
+    self.entries_by_key = collections.defaultdict(collections.deque)
+    self.entries_by_methods = collections.defaultdict(collections.deque)
+
+    with open(filename) as f:
+      for line in f:
+        if not line.strip():
+          continue
+        entry = json.loads(line)
+        self.entries_by_key[request_key(entry['request'])].append(entry)
+        self.entries_by_methods[request_key(entry['request'], False)].append(entry)
+
+    # Replayed entries, so fallbacks do not serve them twice
+    self.served = set()
+
+    # Requests may come from several threads
+    self.lock = threading.Lock()
+
+  def _next(self, queue_):
+    '''
+    Returns the next entry in queue_ not served yet, or None
+    '''
+    while queue_:
+      entry = queue_.popleft()
+      if id(entry) not in self.served:
+        self.served.add(id(entry))
+        return entry
+    return None
+
+  def _post(self, headers, body):
+    request = redact(body)
+
+    with self.lock:
+      entry = self._next(self.entries_by_key[request_key(request)])
+      if entry is None:
+        entry = self._next(self.entries_by_methods[request_key(request, False)])
+        if entry is not None:
+          logging.debug("Replaying response with other params for %s",
+            request_key(request, False))
+
+    if entry is None:
+      raise kanboard.ClientError(
+        'No recorded response for {}'.format(request_key(request)))
+
+    if self.pace == 'original':
+      time.sleep(entry['seconds'])
+
+    if 'error' in entry:
+      raise kanboard.ClientError(entry['error'])
+
+    return json.dumps(entry['response']).encode()
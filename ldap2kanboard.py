@@ -1,492 +1,1207 @@
 #!/usr/bin/env python3
 # _*_ coding: utf-8
 
+import argparse
+import concurrent.futures
 import configparser
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+import hmac
+import http.server
+import json
 import ldap3
 import logging
-import re
+import os
+import socketserver
 import ssl
 import sys
+import threading
+import urllib.parse
 
-import kanboard
+import eventlog
 import json2kanboard
-
-# Import configuration
+import kanboard_client
+import ldap_users
+import lifecycle
+import profiling
+import project_template
+import simulation
+import sync_state
+
+# The phases of a run, in order
+PHASES = ('users', 'lifecycle', 'housekeeping')
+
+# The roles given to the projects. See create_lifecycle_projects()
+ROLES = ('ROLE_MANAGER',)
+
+# Command line options
+parser = argparse.ArgumentParser(description = "Sync LDAP users with Kanboard")
+parser.add_argument('--uid', action = 'append', default = [],
+  help = "Only sync this user (May be repeated, or a comma separated list)")
+parser.add_argument('--phase', action = 'append', choices = PHASES,
+  help = "Only run this phase (May be repeated). Default: All phases.")
+parser.add_argument('--serve', action = 'store_true',
+  help = "Wait for sync requests on the address in [trigger] listen")
+parser.add_argument('--profile', action = 'store_true',
+  help = "Print the time spent per phase, and the slowest projects and API methods")
+parser.add_argument('--profile-output', metavar = 'FILE',
+  help = "Write a cProfile capture of all threads to FILE (Implies --profile)")
+parser.add_argument('--profile-top', metavar = 'N', type = int, default = 10,
+  help = "Number of slowest projects and API methods to list (Default: 10)")
+parser.add_argument('--record', metavar = 'FILE',
+  help = "Record all Kanboard requests and responses to FILE (JSONL)")
+parser.add_argument('--replay', metavar = 'FILE',
+  help = "Serve the Kanboard responses recorded in FILE instead of calling Kanboard. "
+    "LDAP is still searched, and the state is not saved.")
+parser.add_argument('--replay-pace', choices = ('original', 'fast'), default = 'fast',
+  help = "Take as long as the recorded requests, or respond at once (Default: fast)")
+parser.add_argument('--save-snapshot', metavar = 'FILE',
+  help = "Write the LDAP users and the identifiers of the Kanboard projects to FILE "
+    "for --simulate. Nothing is changed.")
+parser.add_argument('--simulate', nargs = 2, metavar = ('FROM', 'TO'),
+  type = date.fromisoformat,
+  help = "Print the projects, tasks and requests a daily sync would make from "
+    "FROM to TO (YYYY-MM-DD), without any Kanboard requests. Needs --snapshot.")
+parser.add_argument('--snapshot', metavar = 'FILE',
+  help = "The snapshot written by --save-snapshot to simulate from")
+args = parser.parse_args()
+
+if args.simulate and not args.snapshot:
+  parser.error("--simulate needs --snapshot")
+
+# Import configuration. Lifecycle rules not in the file are the defaults.
 config = configparser.ConfigParser()
+config.read_dict(lifecycle.DEFAULT_CONFIG)
 config.read("ldap2kanboard.conf")
 
-# Configure logging
-logging.basicConfig(
-    level = eval(config.get("logging", 'level')),
-    filename = config.get("logging", 'file'),
-    format='%(asctime)s:%(levelname)s:%(message)s'
+# Configure logging. Records are written from a background thread.
+eventlog.setup(
+    config.get("logging", 'file'),
+    eval(config.get("logging", 'level')),
+    config.get("logging", 'format', fallback='text')
 )
 
-# 
+#
 logging.info("Running ldap2kanboard.py")
 
+# Templates from the section [json] of old configuration files
+lifecycle.apply_json_section(config)
+
+
+# Time phases, projects and API requests
+profiler = profiling.Profiler(args.profile, args.profile_output)
+
+# Record the Kanboard traffic
+recorder = kanboard_client.Recorder(args.record) if args.record else None
+
+# Create Kanboard API instance. Recorded responses if replaying.
+if args.replay:
+  logging.info("Replaying Kanboard responses from '%s'", args.replay)
+  kb = kanboard_client.ReplayClient(
+    args.replay,
+    pace = args.replay_pace,
+    profiler = profiler if profiler.enabled else None,
+    recorder = recorder
+  )
+else:
+  kb = kanboard_client.Client(
+    config.get("kanboard","url"),
+    config.get("kanboard","user"),
+    config.get("kanboard","password"),
+    pool_size = config.getint("kanboard", "pool_size", fallback=4),
+    connect_timeout = config.getfloat("kanboard", "connect_timeout", fallback=10),
+    read_timeout = config.getfloat("kanboard", "read_timeout", fallback=60),
+    compress = config.getboolean("kanboard", "compress", fallback=True),
+    profiler = profiler if profiler.enabled else None,
+    recorder = recorder
+  )
+
+# LDAP fields with the users start and end dates
+USER_START_DATE_FIELD = config.get("lifecycle", "start_date_field")
+USER_END_DATE_FIELD = config.get("lifecycle", "end_date_field")
+
+# The lifecycle projects (Onboarding, offboarding, ...) to create
+rules = lifecycle.load_rules(config)
+
+# LDAP attributes used as keys by any rule
+key_attributes = sorted(set([a for rule in rules for a in rule.keys]))
+
+# LDAP attributes to fetch for every user
+LDAP_ATTRIBUTES = list(set([
+  'uid',
+  'cn',
+  'userPassword',
+  'uidNumber',
+  USER_START_DATE_FIELD,
+  USER_END_DATE_FIELD,
+  'homePhone',
+  'o',
+  'title',
+  'mail',
+  'fdPrivateMail',
+  'employeeType',
+  'manager',
+  'modifyTimestamp'
+  ] + key_attributes))
+
+
+class Shard:
+  '''
+  A part of the LDAP directory (One office, ...) searched and provisioned
+  on its own, in parallel with the other shards.
+
+  name: The name of the shard, as in the section '[shard:<name>]'
+
+  search_base: The LDAP search base
+
+  search_filter: The LDAP search filter
+  '''
+
+  def __init__(self, name, search_base, search_filter):
+    self.name = name
+    self.search_base = search_base
+    self.search_filter = search_filter
+
+    # The LDAP users (ldap_users.User) of the shard. None if the search failed.
+    self.users = None
+
+
+def load_shards(config):
+  '''
+  Returns list of Shard objects for the shards named in option 'shards'
+  in section 'ldap'. Options not set in a '[shard:<name>]' section are
+  read from section 'ldap'. Without shards, the search base and filter
+  in section 'ldap' is the only shard.
+  '''
+  names = config.get("ldap", "shards", fallback="").split()
+
+  if not names:
+    return [Shard(
+      'default',
+      config.get("ldap", "search_base"),
+      config.get("ldap", "search_filter")
+      )]
+
+  return [
+    Shard(
+      name,
+      config.get("shard:" + name, "search_base",
+        fallback=config.get("ldap", "search_base", fallback=None)),
+      config.get("shard:" + name, "search_filter",
+        fallback=config.get("ldap", "search_filter", fallback=None))
+      )
+    for name in names
+    ]
 
-# Create Kanboard API instance
-kb = kanboard.Client(
-    config.get("kanboard","url"), 
-    config.get("kanboard","user"), 
-    config.get("kanboard","password") 
-)
 
-# Create an LDAP instance
-t = ldap3.Tls(validate=ssl.CERT_NONE)
+def ldap_connection():
+  '''
+  Returns a new bound LDAP connection. Connections are not shared
+  between threads, so every shard has its own.
+  '''
+  t = ldap3.Tls(validate=ssl.CERT_NONE)
+
+  server = ldap3.Server(
+    config.get("ldap","url"),
+    tls = t
+  )
+
+  con = ldap3.Connection(
+    server,
+    config.get("ldap","bind_dn"),
+    config.get("ldap","password"),
+    auto_bind=False
+  )
+
+  con.open()
+  con.start_tls()
+  con.bind()
+
+  return con
+
+
+def search_shard(shard, uids = None):
+  '''
+  Searches for the users of a shard. Sets shard.users to the list of
+  users (ldap_users.User), or None if the search failed.
+
+  uids: If set, only the users with these uids are looked up
+  '''
+  search_filter = shard.search_filter
+
+  # Look up the users directly instead of searching the whole shard
+  if uids:
+    search_filter = '(&{}(|{}))'.format(search_filter, ''.join([
+      '(uid={})'.format(ldap3.utils.conv.escape_filter_chars(uid))
+      for uid in uids
+      ]))
+
+  try:
+    with profiler.capture():
+      con = ldap_connection()
+
+      shard.users = ldap_users.search_users(
+        con,
+        shard.search_base,
+        search_filter,
+        LDAP_ATTRIBUTES,
+        USER_START_DATE_FIELD,
+        USER_END_DATE_FIELD,
+        key_attributes,
+        config.getint("ldap", "page_size", fallback=ldap_users.PAGE_SIZE)
+        )
 
-server = ldap3.Server(
-  config.get("ldap","url"),
-  tls = t
-)
+      if shard.users is None:
+        logging.error("LDAP search of shard '%s' failed: %s",
+          shard.name, con.result.get('message') or con.result.get('description'))
 
-con = ldap3.Connection(
-  server,
-  config.get("ldap","bind_dn"),
-  config.get("ldap","password"),
-  auto_bind=False
-)
+      con.unbind()
 
-con.open()
-con.start_tls()
-con.bind()
-
-# FIXME: Move these to config file
-USER_START_DATE_FIELD = 'fdContractStartDate'
-USER_END_DATE_FIELD = 'fdContractEndDate'
-ONBOARDING_PROJECT_ID_PREFIX = 'ONBOARDING'
-OFFBOARDING_PROJECT_ID_PREFIX = 'OFFBOARDING'
-MY_TASKS_PROJECT_ID_PREFIX = 'MYTASKS'
-
-# Days to offboarding for types of users
-days_for_offboarding = {
-  "employee": 4*7,
-  "hours": 4*7,
-  "freelancer": 1*7
-}
-
-# The JSON file used for onboarding
-ONBOARDING_JSON = config.get("json", "onboarding")
-OFFBOARDING_JSON = config.get("json", "offboarding")
-MY_TASK_JSON = config.get("json", "my_tasks")
-
-# Search for users
-con.search(
-  config.get("ldap", "search_base"),
-  config.get("ldap", "search_filter"),
-  attributes = [
-    'uid',
-    'cn',
-    'userPassword',
-    'uidNumber',
-    USER_START_DATE_FIELD,
-    USER_END_DATE_FIELD,
-    'homePhone',
-    'o',
-    'title',
-    'mail',
-    'fdPrivateMail',
-    'employeeType',
-    'manager'
-    ] 
-)
+  except ldap3.core.exceptions.LDAPException as e:
+    logging.error("LDAP search of shard '%s' failed: %s", shard.name, e)
 
+  if shard.users is not None:
+    logging.info("Found %s users in shard '%s'", len(shard.users), shard.name)
 
-# A dict of LDAP users with uid as key
-ldap_users_by_uid = { str(u.uid):u for u in con.entries }
 
-# A dict of Kanboard users with username (uid) as key 
-kb_users_by_username = { u['username']: u for u in kb.get_all_users() }
+class Snapshot:
+  '''
+  The Kanboard directory (Users and projects) read once per run, and
+  shared by all shards.
 
-# The time is now
-now = datetime.date(datetime.now(timezone.utc))
+  kb: The Kanboard instance to use
+  '''
 
-#################################
-# Sync LDAP users with Kanboard #
-#################################
-for u in con.entries:
-  
-  # User locked in LDAP
-  if '!' in str(u.userPassword):
+  def __init__(self, kb):
 
-    logging.debug("LDAP user {} is locked".format(u.cn))
+    # A dict of Kanboard users with username (uid) as key
+    self.kb_users_by_username = { u['username']: u for u in kb.get_all_users() }
 
-    # If the LDAP user is a Kanboard user
-    if str(u.uid) in kb_users_by_username:
+    # All existing projects. One request, not one per user.
+    self.projects = kb.get_all_projects()
 
-      # If account is currently active
-      if int(kb_users_by_username[str(u.uid)]['is_active']) == 1:
+    # Identifiers of all existing projects
+    self.project_identifiers = set([
+      p['identifier'] for p in self.projects if p.get('identifier')
+      ])
 
-        # Disable the locked user
-        r = kb.disable_user(
-          user_id = kb_users_by_username[str(u.uid)]['id']
-        )
-        
-        # Log the result
-        if r:
-          logging.info("Disabled Kanboard user {} because the account is locked in LDAP".format(u.cn))
-        else:
-          logging.error("Could not disable Kanboard user {}.".format(u.cn))
+    # Open tasks by user. Shared by all projects, so only counted once.
+    self.workload = json2kanboard.WorkloadIndex(kb, self.projects)
 
-  # User not locked in LDAP
-  else:
-  
-    # User is not a Kanboard user
-    if not str(u.uid) in kb_users_by_username:
+    # Global tags, if used. Shared by all projects, so tags are created once.
+    self.tags = json2kanboard.TagIndex(
+      kb, config.getboolean("kanboard", "global_tags", fallback=False))
+
+    # Members of the groups owning tasks. Each group is fetched once.
+    self.groups = json2kanboard.GroupIndex(kb)
+
+    # Guards project_identifiers, which the shards add created projects
+    # to. Projects are created in parallel. A user is in one shard only.
+    self.lock = threading.Lock()
+
+
+def sync_users(users, snapshot):
+  '''
+  Creates, enables and disables the Kanboard users of the LDAP users
+  in list users
+  '''
+  kb_users_by_username = snapshot.kb_users_by_username
+
+  for u in users:
+
+    # User locked in LDAP
+    if u.locked:
+
+      logging.debug("LDAP user %s is locked", u.cn)
+
+      # If the LDAP user is a Kanboard user
+      if u.uid in kb_users_by_username:
 
-        # Create Kanboard user from data in LDAP
-        r = kb.create_ldap_user(
-          username = str(u.uid)
+        # If account is currently active
+        if int(kb_users_by_username[u.uid]['is_active']) == 1:
+
+          # Disable the locked user
+          r = kb.disable_user(
+            user_id = kb_users_by_username[u.uid]['id']
           )
-        
-        # Log result
-        if r:
-          logging.info("Added ldap user to Kanboard: '{}' ({})".format(u.cn, u.uid))
-        else:
-          logging.error("Could not add ldap user to Kanboard: '{}' ({})".format(u.cn, u.uid))
-    
-    # User is a Kanboard user
+
+          # Log the result
+          if r:
+            run.count('users_disabled')
+            logging.info("Disabled Kanboard user %s because the account is locked in LDAP",
+              u.cn)
+          else:
+            logging.error("Could not disable Kanboard user %s.", u.cn)
+
+    # User not locked in LDAP
     else:
-      
-      # Activate Kanboard user if not active
-      if int(kb_users_by_username[str(u.uid)]['is_active']) == 0:
-        
-        # Activate inactive Kanboard user
-        r = kb.enable_user(
-          user_id = kb_users_by_username[str(u.uid)]['id']
-        )
-        
-        # Log the result
-        if r:
-          logging.info("Re-enabled existing Kanboard user {}".format(u.cn))
-        else:
-          logging.error("Could not re-enable existing Kanboard user {}".format(u.cn))
 
-# Reload a dict of Kanboard users with username (uid) as key 
-kb_users_by_username = { u['username']: u for u in kb.get_all_users() }
+      # User is not a Kanboard user
+      if not u.uid in kb_users_by_username:
 
-#############################
-# Update groups in Kanboard #
-#############################
+          # Create Kanboard user from data in LDAP
+          r = kb.create_ldap_user(
+            username = u.uid
+            )
 
-# FIXME: Update groups in Kanboard based on data in LDAP
+          # Log result
+          if r:
+            run.count('users_created')
+            logging.info("Added ldap user to Kanboard: '%s' (%s)", u.cn, u.uid)
+          else:
+            logging.error("Could not add ldap user to Kanboard: '%s' (%s)", u.cn, u.uid)
 
+      # User is a Kanboard user
+      else:
 
-################################
-# Check Kanboard users in LDAP #
-################################
-'''
-# Should we delete users not in LDAP? Not if we have more than one sync like now!
-for u_uid, u_data in kb_users_by_username.items():
-  if u_uid not in ldap_users_by_uid:
-    logging.info("Not in LDAP: {} ({})"
-      .format(u_data['name'], u_data['email'])
-      )
-'''
-
-##############################
-# Create onboarding projects #
-##############################
-for u in con.entries:
-
-  # Ignore locked users
-  if '!' in str(u.userPassword):
-    logging.debug("Ignoring locked user '{}' is locked".format(u.cn))
-    continue
-
-  # User's start date
-  u_start_date = datetime.date(u[USER_START_DATE_FIELD].value)
-  
-  # User's end date as string
-  if u[USER_END_DATE_FIELD]:
-    u_end_date = datetime.date(u[USER_END_DATE_FIELD].value).strftime('%d-%m-%Y')
-  else:
-    u_end_date = "None"
+        # Activate Kanboard user if not active
+        if int(kb_users_by_username[u.uid]['is_active']) == 0:
 
-  # If the user's start date is in the future
-  if u_start_date > now:
+          # Activate inactive Kanboard user
+          r = kb.enable_user(
+            user_id = kb_users_by_username[u.uid]['id']
+          )
 
-    logging.debug("Check for existance of onboarding project for user '{}'"
-      .format(u.cn))
+          # Log the result
+          if r:
+            run.count('users_enabled')
+            logging.info("Re-enabled existing Kanboard user %s", u.cn)
+          else:
+            logging.error("Could not re-enable existing Kanboard user %s", u.cn)
+
+
+def disable_missing_users(ldap_users_by_uid, snapshot):
+  '''
+  Disables active Kanboard LDAP users not found in any shard.
+  Only safe when all shards were searched.
+  '''
+  missing_users = [
+    u for username, u in snapshot.kb_users_by_username.items()
+    if username not in ldap_users_by_uid
+    and int(u.get('is_ldap_user') or 0) == 1
+    and int(u.get('is_active') or 0) == 1
+    ]
 
-    # Create onboarding project identifier
-    project_identifier = ONBOARDING_PROJECT_ID_PREFIX + str(u.uidNumber)
-    
-    # Look for existing onboarding project
-    r = kb.get_project_by_identifier(
-      identifier = project_identifier
-      )
+  for u in missing_users:
+    logging.info("Not in LDAP: %s (%s). Disabling.", u['name'], u['email'])
 
-    # Abort current iteration if project exists
-    if r:
-      logging.debug("Onboarding project exists for '{}'. Don't create."
-        .format(u.cn))
-      continue
+  # Disable the users in one batch
+  results = kanboard_client.execute_batch(kb, [
+    ('disable_user', {'user_id': u['id']}) for u in missing_users
+    ])
 
-    # Assume no roles
-    roles = {}
+  run.count('users_disabled', results.count(True))
 
-    # Define placeholders
-    placeholders = {
-      'NEW_USER_NAME': u.cn,
-      'NEW_USER_UID': u.uid,
-      'NEW_USER_TITLE': u.title,
-      'NEW_USER_TYPE': u.employeeType,
-      'NEW_USER_COMPANY': u.o,
-      'NEW_USER_START_DATE': u_start_date.strftime('%d-%m-%Y'),
-      'NEW_USER_END_DATE': u_end_date,
-      'NEW_USER_PRIVATE_MAIL': u.fdPrivateMail,
-      'NEW_USER_WORK_MAIL': u.mail,
-      'NEW_USER_PRIVATE_PHONE': u.homePhone.value
-      }
-
-    # Pattern for extracting uid from a DN
-    p = re.compile('uid=([a-z]+)')
-
-    # Match object. None if no match
-    m = p.match(str(u['manager']))
-
-    # If we have a match
-    if m:
-      # Extract the uid from the managers DN
-      u_manager_uid = m.group(1)
-
-      # Add manager role
-      roles['ROLE_MANAGER'] = u_manager_uid
-
-      # Add manager name to placeholders
-      placeholders['NEW_USER_MANAGER_NAME'] = \
-        ldap_users_by_uid[u_manager_uid]['cn']
+  if len(results) - results.count(True):
+    logging.error("Could not disable %s users not in LDAP",
+      len(results) - results.count(True))
 
-    else:
-      # Warn if no manager
-      logging.warning("No manager found for user ''".format(u.cn))
 
-    keys = [
-      str(u.employeeType),
-      str(u.o)
-    ]
+def check_templates():
+  '''
+  Checks the templates of all rules.
 
-    # Project description with placeholders
-    description = (
-      "* Name: NEW_USER_NAME (NEW_USER_UID)\n" +
-      "* Private email: NEW_USER_PRIVATE_MAIL\n" +
-      "* Private phone: NEW_USER_PRIVATE_PHONE\n" +
-      "* Work email: NEW_USER_WORK_MAIL\n" +
-      "* Company: NEW_USER_COMPANY\n" +
-      "* Title: NEW_USER_TITLE\n" +
-      "* Start date: NEW_USER_START_DATE\n" +
-      "* End date: NEW_USER_END_DATE\n" +
-      "* Type: NEW_USER_TYPE\n" +
-      "* People manager: NEW_USER_MANAGER_NAME"
-      )
+  Raises project_template.TemplateError if a template is invalid, uses
+  roles not given to the projects, or has tasks without id in a rule
+  with reconcile
+  '''
+  for rule in rules:
+    template = project_template.check(rule.template)
 
-    # Create the kanboard project
-    json2kanboard.create_project(
-      ONBOARDING_JSON,
-      kb,
-      project_description = description,
-      project_identifier = project_identifier,
-      due_date = u_start_date,
-      roles = roles,
-      placeholders = placeholders,
-      keys = keys
-      )
+    # Without ids, an edited title would replace the tasks of all projects
+    if rule.reconcile and not template.has_task_ids():
+      raise project_template.TemplateError(
+        "Template '{}' has tasks without 'id'. Rule '{}' reconciles projects, so every task needs an id.".format(
+          rule.template, rule.name))
 
-    # Log the completion of the project
-    logging.info("Created onboarding project for '{}'"
-      .format(u.cn))
+    unknown_roles = template.roles() - set(ROLES)
+    if unknown_roles:
+      raise project_template.TemplateError(
+        "Template '{}' uses unknown roles: {}".format(
+          rule.template, ', '.join(sorted(unknown_roles))))
 
-###############################
-# Create offboarding projects #
-###############################
 
-for u in con.entries:
+def check_template_keys(users):
+  '''
+  Warns about keys in the templates of the rules no LDAP user in
+  list users has
+  '''
+  for rule in rules:
 
-  # Ignore user if no end date
-  if not u[USER_END_DATE_FIELD]:
-    continue
+    # All values of the key attributes of the rule
+    vocabulary = set([
+      u.attributes[a].lower() for u in users for a in rule.keys
+      ])
 
-  u_days_left = \
-    (u[USER_END_DATE_FIELD].value - datetime.now(timezone.utc)).days
-    #datetime.now(timezone.utc) - u[USER_END_DATE_FIELD].value
+    unknown_keys = project_template.load(rule.template).keys() - vocabulary
+    if unknown_keys and rule.keys:
+      logging.warning("Keys in template '%s' no user has: %s",
+        rule.template, ', '.join(sorted(unknown_keys)))
 
 
-  # Abort if we don't know the offboarding time for the user time 
-  if u.employeeType.value not in days_for_offboarding.keys():
-    logging.error("User type '{}' for user '{}' is undefined"
-      .format(u.employeeType, u.cn))
-    continue
+def find_outdated_projects(snapshot, identifiers = None):
+  '''
+  Finds existing projects of rules with reconcile, where the template
+  changed since the project was created or last reconciled. Projects
+  marked as not reconcilable by json2kanboard.reconcile_project() are
+  left out.
 
+  identifiers: If set, only the projects with these identifiers are
+  checked (e.g. the projects of the users named in a targeted sync)
 
-  # Is it time to offboard for this type of user?
-  if u_days_left <= days_for_offboarding[u.employeeType.value]:
+  Returns dict of (project, metadata) tuples by identifier
+  '''
+  outdated_projects = {}
 
-    # Create onboarding project identifier
-    project_identifier = OFFBOARDING_PROJECT_ID_PREFIX + str(u.uidNumber)
+  for rule in [rule for rule in rules if rule.reconcile]:
 
-    # Look for existing onboarding project
-    r = kb.get_project_by_identifier(
-      identifier = project_identifier
-      )
+    # Checksum of the template now
+    checksum = project_template.load(rule.template).checksum
+
+    # Active projects of the rule
+    rule_projects = [
+      p for p in snapshot.projects if rule.is_identifier(p.get('identifier'))
+      and int(p.get('is_active', 1)) == 1
+      and (identifiers is None or p['identifier'] in identifiers)
+      ]
+
+    # The metadata of all the projects in one batch
+    metadata = kanboard_client.execute_batch(kb, [
+      ('get_project_metadata', {'project_id': p['id']}) for p in rule_projects
+      ])
+
+    for p, m in zip(rule_projects, metadata):
+
+      # Projects without tagged tasks can not be reconciled
+      if (m or {}).get('reconcile') == 'untagged':
+        continue
+
+      if (m or {}).get('template_checksum') != checksum:
+        outdated_projects[p['identifier']] = (p, m or {})
+
+  return outdated_projects
+
+
+def create_lifecycle_projects(users, snapshot, ldap_users_by_uid,
+  lifecycle_uids, outdated_projects):
+  '''
+  Evaluates the rules for the users in list users with uid in
+  lifecycle_uids, and creates or reconciles their projects
+  '''
+  for u in users:
 
-    # Abort current iteration if project exists
-    if r:
-      logging.debug("Offboarding project exists for '{}'. Don't create."
-        .format(u.cn))
+    # Ignore users with no action due and no changes in LDAP
+    if u.uid not in lifecycle_uids:
       continue
 
-    #print("User '{}({})' of type '{}' has end date in {} days."
-    #  .format(u.cn, u.uid, u.employeeType, u_days_left))
+    run.count('users_handled')
 
-    # The user's end date
-    u_start_date = datetime.date(u[USER_START_DATE_FIELD].value)
-    u_end_date = datetime.date(u[USER_END_DATE_FIELD].value)
+    # Values shared by all rules (Dates, manager, placeholders, ...)
+    values = lifecycle.user_values(u, ldap_users_by_uid)
 
-    # Assume no roles
+    # The manager is known to the projects as a role
     roles = {}
+    if values['manager_uid']:
+      roles['ROLE_MANAGER'] = values['manager_uid']
 
-    # Define placeholders
-    placeholders = {
-      'USER_NAME': u.cn.value,
-      'USER_UID': u.uid.value,
-      'USER_TITLE': u.title.value,
-      'USER_TYPE': u.employeeType.value,
-      'USER_COMPANY': u.o.value,
-      'USER_START_DATE': u_start_date.strftime('%d-%m-%Y'),
-      'USER_END_DATE': u_end_date.strftime('%d-%m-%Y'),
-      'USER_PRIVATE_MAIL': u.fdPrivateMail.value,
-      'USER_WORK_MAIL': u.mail.value
-      }
-
-    # Pattern for extracting uid from a DN
-    p = re.compile('uid=([a-z]+)')
-
-    # Match object. None if no match
-    m = p.match(u['manager'].value)
-
-    # If we have a match
-    if m:
-      # Extract the uid from the managers DN
-      u_manager_uid = m.group(1)
-
-      # Add manager role
-      roles['ROLE_MANAGER'] = u_manager_uid
-
-      # Add manager name to placeholders
-      placeholders['USER_MANAGER_NAME'] = \
-        ldap_users_by_uid[u_manager_uid]['cn'].value
+    # The earliest date a rule opens after today
+    next_date = None
+
+    # Try again next run if a project was not created
+    retry = False
+
+    # Evaluate all rules for the user
+    for rule in rules:
+
+      is_open, opens = rule.window(values, now)
+
+      # Keep track of the next date the user is due
+      if opens and (next_date is None or opens < next_date):
+        next_date = opens
+
+      # Create project identifier
+      project_identifier = rule.identifier(values)
+
+      # Keys used for matching tasks
+      keys = [values['attributes'][a] for a in rule.keys]
+
+      # Apply changes in the template to the existing project
+      if project_identifier in outdated_projects:
+        project, metadata = outdated_projects[project_identifier]
+
+        # Keep the due date the project was created with
+        if metadata.get('due_date'):
+          due_date = date.fromisoformat(metadata['due_date'])
+        else:
+          due_date = rule.project_due_date(values, now)
+
+        logging.info("Reconciling %s project for user '%s'", rule.name, u.cn)
+
+        with profiler.timer('project', project_identifier):
+          r = json2kanboard.reconcile_project(
+            rule.template,
+            kb,
+            project['id'],
+            project_owner = values['uid'] if rule.project_owner == 'uid' else None,
+            due_date = due_date,
+            roles = roles,
+            placeholders = rule.placeholders(values),
+            keys = keys,
+            workload = snapshot.workload,
+            tag_index = snapshot.tags,
+            group_index = snapshot.groups
+            )
+        run.count('projects_reconciled' if r else 'projects_not_reconciled')
+        continue
+
+      # No project for the user yet
+      if not is_open:
+        continue
+
+      # Abort current rule if project exists
+      if project_identifier in snapshot.project_identifiers:
+        logging.debug("Project '%s' exists for '%s'. Don't create.",
+          project_identifier, u.cn)
+        continue
+
+      logging.info("Creating %s project for user '%s'", rule.name, u.cn)
 
-    else:
       # Warn if no manager
-      logging.warning("No manager found for user ''".format(u.cn))
-
-
-    # Project description with placeholders
-    description = (
-      "* Name: USER_NAME (USER_UID)\n" +
-      "* Private email: USER_PRIVATE_MAIL\n" +
-      "* Work email: USER_WORK_MAIL\n" +
-      "* Company: USER_COMPANY\n" +
-      "* Title: USER_TITLE\n" +
-      "* Start date: USER_START_DATE\n" +
-      "* End date: USER_END_DATE\n" +
-      "* Type: USER_TYPE\n" +
-      "* People manager: USER_MANAGER_NAME"
-      )
+      if not values['manager_uid']:
+        logging.warning("No manager found for user '%s'", u.cn)
+
+      # Create the kanboard project
+      with profiler.timer('project', project_identifier):
+        r = json2kanboard.create_project(
+          rule.template,
+          kb,
+          project_owner = values['uid'] if rule.project_owner == 'uid' else None,
+          project_description = rule.description,
+          project_identifier = project_identifier,
+          due_date = rule.project_due_date(values, now),
+          roles = roles,
+          placeholders = rule.placeholders(values),
+          keys = keys,
+          golden = rule.golden,
+          workload = snapshot.workload,
+          tag_index = snapshot.tags,
+          group_index = snapshot.groups
+          )
 
-    # Keys used for matching tasks
-    keys = [
-      str(u.employeeType),
-      str(u.o)
-    ]
+      # Try again next run if the project was not created
+      if not r:
+        run.count('projects_failed')
+        retry = True
+        continue
 
-    # Create the kanboard project
-    json2kanboard.create_project(
-      OFFBOARDING_JSON,
-      kb,
-      project_description = description,
-      project_identifier = project_identifier,
-      due_date = u_end_date,
-      roles = roles,
-      placeholders = placeholders,
-      keys = keys
-      )
+      run.count('projects_created')
+      with snapshot.lock:
+        snapshot.project_identifiers.add(project_identifier)
 
-    # Log the completion of the project
-    logging.info("Created offboarding project for '{}'"
-      .format(u.cn))
+      # Log the completion of the project
+      logging.info("Created %s project for '%s'", rule.name, u.cn)
 
+    # Schedule the users next lifecycle action. Failed users are retried.
+    if retry:
+      state.schedule(u.uid, now)
+    else:
+      state.schedule(u.uid, next_date)
 
-#####################################
-# Create personal Kanboard projects #
-#####################################
 
-for u in con.entries:
+def provision_shard(shard, snapshot, ldap_users_by_uid, lifecycle_uids,
+  outdated_projects, phases = PHASES):
+  '''
+  Syncs the users of a shard with Kanboard and creates their
+  lifecycle projects
+  '''
+  with profiler.capture():
 
-  # Demo: Only create for this user
-  #if u.uid != 'plj':
-  #  continue
+    if 'users' in phases:
+      with profiler.timer('phase', "users (Shard '{}')".format(shard.name)):
+        sync_users(shard.users, snapshot)
 
-  # Identifier for users personal project
-  project_identifier = MY_TASKS_PROJECT_ID_PREFIX + str(u.uidNumber) 
-  
-  # Try to get existing Kanboard project
-  r = kb.get_project_by_identifier(
-    identifier = project_identifier
-    )
-  
-  # Abort if personal project exists
-  if r:
-    logging.debug("Personal Kanboard project for user '{}' exists"
-      .format(u.cn))
-    continue
-  
-    
-  # Create personal Kanboard project for user
-  logging.info("Creating personal Kanboard project for user '{}'"
-    .format(u.cn))
-
-  # Keys used for matching tasks
-  keys = [
-    str(u.employeeType),
-    str(u.o)
+    if 'lifecycle' in phases:
+      with profiler.timer('phase', "lifecycle (Shard '{}')".format(shard.name)):
+        create_lifecycle_projects(shard.users, snapshot, ldap_users_by_uid,
+          lifecycle_uids, outdated_projects)
+
+  logging.info("Provisioned shard '%s'", shard.name)
+
+
+def archive_lifecycle_projects(users, snapshot):
+  '''
+  Archives (Disables) the lifecycle boards of the housekeeping rules
+  that are no longer in use
+  '''
+
+  # Rules with boards to archive. No housekeeping if not set.
+  housekeeping_rules = [
+    rule for rule in rules
+    if rule.name in config.get("housekeeping", "rules", fallback="").split()
     ]
 
-  # Ignore locked users
-  if '!' in str(u.userPassword):
-    logging.debug("Ignoring locked user '{}' is locked".format(u.cn))
-    continue
+  # Days all tasks must have been closed before archiving
+  days_closed = config.getint("housekeeping", "days_closed", fallback=30)
+
+  # Days after the users end date before archiving
+  days_after_end = config.getint("housekeeping", "days_after_end", fallback=30)
+
+  # Active boards of the rules. New projects have open tasks, so the
+  # project list from before the projects were created will do.
+  housekeeping_projects = [
+    p for p in snapshot.projects
+    if int(p.get('is_active', 1)) == 1
+    and any(rule.is_identifier(p.get('identifier')) for rule in housekeeping_rules)
+    ]
 
-  # Define placeholders
-  placeholders = {
-    'USER_NAME': u.cn,
-    'USER_EMAIL': u.mail,
+  # The users end dates by uidNumber
+  end_date_by_uid_number = {
+    u.uid_number: u.end for u in users if u.end
     }
 
-  # Start date is now if start date is in the past
-  u_start_date = max(
-    datetime.now(timezone.utc),
-    u[USER_START_DATE_FIELD].value
+  # The end dates of the users of the boards. The uidNumber is the end
+  # of the identifier.
+  end_date_by_project_id = {}
+  projects_without_end_date = []
+
+  for p in housekeeping_projects:
+    rule = [rule for rule in housekeeping_rules if rule.is_identifier(p['identifier'])][0]
+    uid_number = p['identifier'][len(rule.identifier_prefix):]
+
+    if uid_number in end_date_by_uid_number:
+      end_date_by_project_id[p['id']] = end_date_by_uid_number[uid_number]
+
+    # Users who left may be gone from LDAP. The due date the board was
+    # created with is then the end date, if the rule is due on the end date.
+    elif rule.due_date == 'end':
+      projects_without_end_date.append(p)
+
+  # Open and closed tasks of all the boards, and the metadata of the
+  # boards of users not in LDAP, in one batch
+  results = kanboard_client.execute_batch(kb, [
+    ('get_all_tasks', {'project_id': p['id'], 'status_id': status_id})
+    for p in housekeeping_projects for status_id in (1, 0)
+    ] + [
+    ('get_project_metadata', {'project_id': p['id']})
+    for p in projects_without_end_date
+    ])
+
+  task_lists = results[:2*len(housekeeping_projects)]
+
+  for p, metadata in zip(projects_without_end_date, results[2*len(housekeeping_projects):]):
+    if metadata and metadata.get('due_date'):
+      end_date_by_project_id[p['id']] = date.fromisoformat(metadata['due_date'])
+
+  # Boards to archive
+  stale_projects = []
+
+  for i, p in enumerate(housekeeping_projects):
+
+    open_tasks = task_lists[2*i]
+    closed_tasks = task_lists[2*i+1]
+
+    # Without the tasks it is unknown if the board is in use
+    if open_tasks is None or closed_tasks is None:
+      logging.error("Could not get the tasks of project '%s'. Not archiving.", p['name'])
+      continue
+
+    end_date = end_date_by_project_id.get(p['id'])
+
+    # The user left more than days_after_end ago
+    if end_date and (now - end_date).days > days_after_end:
+      logging.info("Archiving project '%s'. User left %s.", p['name'], end_date)
+      stale_projects.append(p)
+      continue
+
+    # Boards with open tasks are in use
+    if open_tasks:
+      continue
+
+    # Time the last task was closed. The board's last change if no tasks.
+    last_closed = max(
+      [int(t.get('date_completed') or 0) for t in closed_tasks] +
+      [int(p.get('last_modified') or 0)]
+      )
+
+    if (now - datetime.date(datetime.fromtimestamp(last_closed, timezone.utc))).days > days_closed:
+      logging.info("Archiving project '%s'. All tasks closed.", p['name'])
+      stale_projects.append(p)
+
+  # Archive the boards in one batch
+  results = kanboard_client.execute_batch(kb, [
+    ('disable_project', {'project_id': p['id']}) for p in stale_projects
+    ])
+
+  run.count('projects_archived', results.count(True))
+  logging.info("Archived %s of %s lifecycle projects (%s failed)",
+    results.count(True),
+    len(housekeeping_projects),
+    len(results) - results.count(True))
+
+
+# Only one sync at a time
+sync_lock = threading.Lock()
+
+
+def sync(uids = None, phases = PHASES):
+  '''
+  Syncs LDAP with Kanboard.
+
+  uids: If set, only the users with these uids are looked up in LDAP and
+  handled, whether due and changed or not. Users missing from LDAP are
+  not disabled and there is no housekeeping, as only part of the
+  directory is known.
+
+  phases: The phases to run ('users', 'lifecycle' and 'housekeeping')
+
+  Returns dict with the counters of the run
+  '''
+  global run, now, state
+
+  with sync_lock:
+
+    # Counts what the run did. Logged as one record when done.
+    run = eventlog.Rollup('run')
+
+    if uids:
+      logging.info("Syncing users %s (%s)", ', '.join(uids), ', '.join(phases))
+      if 'housekeeping' in phases:
+        logging.warning("No housekeeping when syncing single users")
+        phases = [phase for phase in phases if phase != 'housekeeping']
+
+    # A broken template stops the run before any request is sent
+    if 'lifecycle' in phases:
+      check_templates()
+
+    # The parts of the directory to sync
+    shards = load_shards(config)
+
+    # Threads for searching and provisioning the shards
+    max_workers = config.getint("ldap", "max_workers", fallback=len(shards))
+
+    ##################################
+    # Search for users in all shards #
+    ##################################
+    with profiler.phase('ldap search'):
+      with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        list(pool.map(lambda shard: search_shard(shard, uids), shards))
+
+    # Shards found
+    searched_shards = [shard for shard in shards if shard.users is not None]
+
+    # A dict of LDAP users with uid as key. The union of all shards. Users
+    # in more than one shard are only provisioned by the first.
+    ldap_users_by_uid = {}
+
+    for shard in searched_shards:
+      users = []
+      for u in shard.users:
+        if u.uid in ldap_users_by_uid:
+          logging.debug("User '%s' in shard '%s' already found", u.uid, shard.name)
+          continue
+        ldap_users_by_uid[u.uid] = u
+        users.append(u)
+      shard.users = users
+
+    # The LDAP users of all shards
+    all_users = list(ldap_users_by_uid.values())
+
+    for uid in (uids or []):
+      if uid not in ldap_users_by_uid:
+        logging.warning("User '%s' not found in LDAP", uid)
+
+    # Keys in the templates no user has will never match
+    if 'lifecycle' in phases and not uids:
+      check_template_keys(all_users)
+
+    # The managers of the users are needed for the project placeholders
+    if uids and 'lifecycle' in phases:
+      manager_uids = set([
+        u.manager_uid for u in all_users if u.manager_uid
+        ]) - set(ldap_users_by_uid)
+
+      if manager_uids:
+        managers = load_shards(config)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+          list(pool.map(lambda shard: search_shard(shard, manager_uids), managers))
+        for shard in managers:
+          for u in (shard.users or []):
+            ldap_users_by_uid.setdefault(u.uid, u)
+
+    # Users and projects in Kanboard, shared by all shards
+    with profiler.phase('kanboard snapshot'):
+      snapshot = Snapshot(kb)
+
+    # The time is now
+    now = datetime.date(datetime.now(timezone.utc))
+
+    # Load the state from last run. Without a state file, all users are handled.
+    state = sync_state.SyncState(config.get("state", "file", fallback=None))
+
+    # Users to handle in the lifecycle phases
+    lifecycle_uids = set()
+
+    # Existing projects to reconcile, by identifier
+    outdated_projects = {}
+
+    # Users with a lifecycle action due today
+    due_uids = set()
+
+    # True if the rules changed since last run
+    rules_changed = False
+
+    if 'lifecycle' in phases:
+
+      # The named users are always handled. Other users stay scheduled.
+      if uids:
+        for u in all_users:
+          state.changed(u.uid, u.modified)
+        lifecycle_uids = set(ldap_users_by_uid) & set(uids)
+
+      else:
+
+        # Changed rules may be due for any user. All users are handled.
+        rules_changed = state.rules_changed(lifecycle.rules_checksum(config))
+        if rules_changed:
+          logging.info("Lifecycle rules changed since last run. Handling all users.")
+
+        due_uids = state.pop_due(now)
+
+        # Users new or changed in LDAP since last run. Always check all users,
+        # so all timestamps are recorded.
+        changed_uids = set([
+          u.uid for u in all_users
+          if state.changed(u.uid, u.modified) or rules_changed
+          ])
+
+        lifecycle_uids = due_uids | changed_uids
+
+        logging.info("%s users due and %s users changed in LDAP",
+          len(due_uids), len(changed_uids))
+
+      # A targeted sync only checks the projects of the named users
+      identifiers = None
+      if uids:
+        identifiers = set([
+          rule.identifier_prefix + u.uid_number
+          for rule in rules for u in all_users
+          if u.uid in lifecycle_uids and u.uid_number
+          ])
+
+      with profiler.phase('template changes'):
+        outdated_projects = find_outdated_projects(snapshot, identifiers)
+
+      # Users with outdated projects must be handled
+      uid_by_uid_number = { u.uid_number: u.uid for u in all_users }
+      for rule in rules:
+        for identifier in outdated_projects:
+          if rule.is_identifier(identifier):
+            uid = uid_by_uid_number.get(identifier[len(rule.identifier_prefix):])
+            if uid:
+              lifecycle_uids.add(uid)
+
+      logging.info("%s projects to reconcile", len(outdated_projects))
+
+    ######################################################
+    # Sync users and create lifecycle projects per shard #
+    ######################################################
+    with profiler.phase('provision'):
+      with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = [
+          pool.submit(provision_shard, shard, snapshot, ldap_users_by_uid,
+            lifecycle_uids, outdated_projects, phases)
+          for shard in searched_shards
+          ]
+
+    for shard, future in zip(searched_shards, futures):
+      if future.exception():
+        run.count('shards_failed')
+        logging.error("Could not provision shard '%s': %s",
+          shard.name, future.exception())
+
+        # The users of the shard may not have been handled. Retry next run.
+        for u in shard.users:
+          if u.uid in lifecycle_uids:
+            state.schedule(u.uid, now)
+
+    # Due users of shards not searched were not handled. Retry next run.
+    if len(searched_shards) < len(shards):
+      for uid in due_uids - set(ldap_users_by_uid):
+        state.schedule(uid, now)
+
+    # Handle all users again next run if not all were handled after a rule change
+    if rules_changed and (run.counts.get('shards_failed') or len(searched_shards) < len(shards)):
+      state.rules_checksum = None
+
+    # Save the state for next run. A replay leaves the state as it was.
+    if 'lifecycle' in phases and not args.replay:
+      state.save()
+
+    #############################
+    # Update groups in Kanboard #
+    #############################
+
+    # FIXME: Update groups in Kanboard based on data in LDAP
+
+
+    ################################
+    # Check Kanboard users in LDAP #
+    ################################
+
+    # Users are only missing if all shards were searched
+    if ('users' in phases and not uids
+      and config.getboolean("ldap", "disable_missing_users", fallback=False)):
+      if len(searched_shards) == len(shards):
+        with profiler.phase('disable missing users'):
+          disable_missing_users(ldap_users_by_uid, snapshot)
+      else:
+        logging.warning("Not all shards searched. Not disabling users not in LDAP.")
+
+
+    ################################
+    # Archive old lifecycle boards #
+    ################################
+    if 'housekeeping' in phases:
+      with profiler.phase('housekeeping'):
+        archive_lifecycle_projects(all_users, snapshot)
+
+
+    # One record for the whole run
+    run.emit(ldap_users = len(all_users), shards = len(searched_shards))
+
+    return dict(run.counts)
+
+
+def save_snapshot(filename):
+  '''
+  Writes the LDAP users of all shards, the Kanboard projects and the
+  names of the Kanboard groups to filename (See simulation.save_snapshot())
+
+  Returns True if all shards were searched
+  '''
+  shards = load_shards(config)
+  max_workers = config.getint("ldap", "max_workers", fallback=len(shards))
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+    list(pool.map(search_shard, shards))
+
+  if any(shard.users is None for shard in shards):
+    logging.error("Not all shards searched. Not writing snapshot.")
+    return False
+
+  # Users in more than one shard belong to the first
+  ldap_users_by_uid = {}
+  for shard in shards:
+    for u in shard.users:
+      ldap_users_by_uid.setdefault(u.uid, u)
+
+  projects = kb.get_all_projects()
+
+  simulation.save_snapshot(
+    filename,
+    list(ldap_users_by_uid.values()),
+    projects,
+    [g['name'] for g in kb.get_all_groups() or []],
+    datetime.date(datetime.now(timezone.utc))
     )
 
-  # Create the kanboard project
-  json2kanboard.create_project(
-    MY_TASK_JSON,
-    kb,
-    project_owner = str(u.uid),
-    project_identifier = project_identifier,
-    due_date = u_start_date,
-    placeholders = placeholders,
-    keys = keys
+  logging.info("Wrote snapshot of %s users and %s projects to '%s'",
+    len(ldap_users_by_uid), len(projects), filename)
+
+  return True
+
+
+def simulate(first_day, last_day, filename):
+  '''
+  Prints what a daily sync would create from first_day to last_day,
+  starting from the snapshot in filename. Kanboard is not called.
+  '''
+  check_templates()
+
+  snapshot = simulation.load_snapshot(filename)
+
+  logging.info("Simulating %s to %s from snapshot '%s' of %s (%s users, %s projects)",
+    first_day, last_day, filename, snapshot['taken'], len(snapshot['users']),
+    len(snapshot['project_identifiers']))
+
+  if first_day < snapshot['taken']:
+    logging.warning("Simulation starts before the snapshot was taken (%s)",
+      snapshot['taken'])
+
+  days = simulation.simulate(
+    rules,
+    snapshot,
+    first_day,
+    last_day,
+    housekeeping_rules = config.get("housekeeping", "rules", fallback="").split(),
+    global_tags = config.getboolean("kanboard", "global_tags", fallback=False)
     )
 
-  # Create personal Kanboard project for user
-  logging.info("Created personal Kanboard project for user '{}'"
-    .format(u.cn))
+  print(simulation.report(days, rules))
+
+
+class TriggerHandler(http.server.BaseHTTPRequestHandler):
+  '''
+  Runs a sync for the users named in a request:
+
+  POST /sync?uid=jdoe&uid=asmith&phase=users&phase=lifecycle
+
+  The parameters may also be sent as JSON in the body, as in
+  {"uid": ["jdoe", "asmith"], "phase": ["users"]}. Without phases,
+  users and lifecycle projects are synced. Responds with the counters
+  of the run as JSON.
+
+  If 'token' is set in section 'trigger', requests must send it in the
+  header X-Trigger-Token. Requests from web pages (With an Origin
+  header) are always refused.
+  '''
+
+  def do_POST(self):
+
+    url = urllib.parse.urlsplit(self.path)
+
+    if url.path != '/sync':
+      self.respond(404, {'error': 'Not found'})
+      return
+
+    # Browsers send Origin with cross-site requests. A web page must
+    # never trigger a sync, even if the browser runs on this host.
+    if self.headers.get('Origin'):
+      self.respond(403, {'error': 'Forbidden'})
+      return
+
+    # The shared token, if any
+    token = config.get("trigger", "token", fallback="")
+    if token and not hmac.compare_digest(
+      self.headers.get('X-Trigger-Token', '').encode(), token.encode()):
+      self.respond(403, {'error': 'Forbidden'})
+      return
+
+    # Parameters from the query and the body. Only JSON bodies, which
+    # a form on a web page can not send.
+    length = int(self.headers.get('Content-Length') or 0)
+    params = urllib.parse.parse_qs(url.query)
+
+    if length:
+      if self.headers.get_content_type() != 'application/json':
+        self.respond(415, {'error': 'The body must be JSON'})
+        return
+
+      try:
+        body = json.loads(self.rfile.read(length).decode())
+      except ValueError:
+        body = None
 
+      if not isinstance(body, dict):
+        self.respond(400, {'error': 'The body must be a JSON object'})
+        return
+
+      for k, v in body.items():
+        params.setdefault(k, []).extend(
+          [str(x) for x in (v if isinstance(v, list) else [v])])
+
+    uids = [uid for value in params.get('uid', []) for uid in value.split(',') if uid]
+    phases = params.get('phase', ['users', 'lifecycle'])
+
+    if not uids:
+      self.respond(400, {'error': 'No uid'})
+      return
+
+    if set(phases) - set(PHASES):
+      self.respond(400, {'error': 'Unknown phase'})
+      return
+
+    try:
+      counts = sync(uids, phases)
+    except Exception as e:
+      logging.exception("Triggered sync of %s failed", uids)
+      self.respond(500, {'error': str(e)})
+      return
+
+    self.respond(500 if counts.get('shards_failed') else 200, counts)
+
+  def respond(self, status, data):
+    '''
+    Sends the dict data as a JSON response
+    '''
+    body = json.dumps(data).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self):
+    # Clients of a Unix socket have no address
+    return self.client_address[0] if self.client_address else 'unix'
+
+  def log_message(self, format, *args):
+    logging.info("Trigger: " + format, *args)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+  '''
+  HTTP server listening on a Unix socket
+  '''
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+    super().server_bind()
+
+
+def serve(listen):
+  '''
+  Waits for sync requests (See TriggerHandler) forever.
+
+  listen: 'host:port' for HTTP over TCP, or the path of a Unix socket
+  '''
+  if '/' in listen:
+    server = UnixHTTPServer(listen, TriggerHandler)
+  else:
+    host, port = listen.rsplit(':', 1)
+    server = http.server.HTTPServer((host, int(port)), TriggerHandler)
+
+  logging.info("Waiting for sync requests on %s", listen)
+  server.serve_forever()
+
+
+# The counters of the sync run
+counts = {}
+
+if args.serve:
+  serve(config.get("trigger", "listen", fallback="127.0.0.1:8025"))
+
+elif args.save_snapshot:
+  if not save_snapshot(args.save_snapshot):
+    sys.exit(1)
+
+elif args.simulate:
+  try:
+    simulate(args.simulate[0], args.simulate[1], args.snapshot)
+  except project_template.TemplateError as e:
+    logging.error("%s. Stopping.", e)
+    sys.exit(1)
+
+else:
+  try:
+    with profiler.capture():
+      counts = sync(
+        [uid for value in args.uid for uid in value.split(',') if uid] or None,
+        args.phase or PHASES
+        )
+  except project_template.TemplateError as e:
+    logging.error("%s. Stopping.", e)
+    sys.exit(1)
+
+# Report where the time went
+if profiler.enabled:
+  print(profiler.report(args.profile_top))
+  profiler.write(args.profile_top)
+
+# A shard failed. Its users are retried next run.
+if counts.get('shards_failed'):
+  logging.error("%s shards failed. Stopping.", counts['shards_failed'])
+  sys.exit(1)
 
 # Log that we completed running the script.
 logging.info("Completed ldap2kontrapunkt.py normally")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import collections
+from datetime import datetime
+import re
+
+
+# Pattern for extracting uid from a DN
+MANAGER_UID_PATTERN = re.compile('uid=([a-z]+)')
+
+# Number of users fetched per page
+PAGE_SIZE = 500
+
+# An LDAP user with the values used by the sync, decoded once. A
+# namedtuple has no per instance dict, so a user is a handful of strings
+# and dates instead of an ldap3 Entry with all its attribute objects.
+#
+# uid, uid_number, cn: The users uid, uidNumber and cn
+# locked: True if the account is locked (userPassword holds a '!')
+# start, end: The users start and end dates (datetime.date or None)
+# type, company, title: employeeType, o and title
+# manager_uid: The uid from the DN in manager, or None
+# mail, private_mail, phone: mail, fdPrivateMail and homePhone
+# modified: modifyTimestamp as string
+# attributes: Dict with the key attributes of the rules as strings
+User = collections.namedtuple('User', [
+  'uid',
+  'uid_number',
+  'cn',
+  'locked',
+  'start',
+  'end',
+  'type',
+  'company',
+  'title',
+  'manager_uid',
+  'mail',
+  'private_mail',
+  'phone',
+  'modified',
+  'attributes',
+  ])
+
+
+def first(attributes, name):
+  '''
+  Returns the first value of attribute name in the dict attributes,
+  or None if the attribute has no values
+  '''
+  value = attributes.get(name)
+
+  if isinstance(value, (list, tuple)):
+    return value[0] if value else None
+
+  return value
+
+
+def as_date(value):
+  '''
+  Returns the date of a datetime (Or a generalized time string),
+  or None
+  '''
+  if not value:
+    return None
+
+  if isinstance(value, str):
+    value = datetime.strptime(value[:8], '%Y%m%d')
+
+  return datetime.date(value)
+
+
+def as_str(value):
+  '''
+  Returns value as string, or None
+  '''
+  if value is None:
+    return None
+
+  if isinstance(value, bytes):
+    return value.decode(errors = 'replace')
+
+  return str(value)
+
+
+def user_from_attributes(attributes, start_date_field, end_date_field,
+  key_attributes = []):
+  '''
+  Returns a User from the dict attributes of an LDAP search result
+  '''
+  # Match object. None if no match
+  m = MANAGER_UID_PATTERN.match(as_str(first(attributes, 'manager')) or '')
+
+  # A locked account has a '!' in one of its password values
+  passwords = attributes.get('userPassword') or []
+  if not isinstance(passwords, (list, tuple)):
+    passwords = [passwords]
+
+  return User(
+    uid = as_str(first(attributes, 'uid')),
+    uid_number = as_str(first(attributes, 'uidNumber')),
+    cn = as_str(first(attributes, 'cn')),
+    locked = any('!' in as_str(p) for p in passwords),
+    start = as_date(first(attributes, start_date_field)),
+    end = as_date(first(attributes, end_date_field)),
+    type = as_str(first(attributes, 'employeeType')),
+    company = as_str(first(attributes, 'o')),
+    title = as_str(first(attributes, 'title')),
+    manager_uid = m.group(1) if m else None,
+    mail = as_str(first(attributes, 'mail')),
+    private_mail = as_str(first(attributes, 'fdPrivateMail')),
+    phone = as_str(first(attributes, 'homePhone')),
+    modified = as_str(first(attributes, 'modifyTimestamp')),
+    attributes = {
+      a: as_str(first(attributes, a)) or '' for a in key_attributes
+      },
+    )
+
+
+def search_users(con, search_base, search_filter, attributes,
+  start_date_field, end_date_field, key_attributes = [],
+  page_size = PAGE_SIZE):
+  '''
+  Searches for users with a paged search, and converts each user to a
+  User as the pages come in. The raw results are not kept.
+
+  con: A bound ldap3 connection
+
+  Returns list of User, or None if the search failed
+  '''
+  users = [
+    user_from_attributes(r['attributes'], start_date_field, end_date_field,
+      key_attributes)
+    for r in con.extend.standard.paged_search(
+      search_base,
+      search_filter,
+      attributes = attributes,
+      paged_size = page_size,
+      generator = True
+      )
+    if r.get('type') == 'searchResEntry'
+    ]
+
+  if (con.result or {}).get('description', 'success') != 'success':
+    return None
+
+  return users
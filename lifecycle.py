@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+from datetime import timedelta
+import hashlib
+import logging
+
+
+# Rules used if not overridden in the configuration file.
+# Read with configparser.read_dict() before the configuration file.
+DEFAULT_CONFIG = {
+  'lifecycle': {
+    'rules': 'onboarding offboarding my_tasks',
+    'start_date_field': 'fdContractStartDate',
+    'end_date_field': 'fdContractEndDate',
+    },
+  'rule:onboarding': {
+    'identifier_prefix': 'ONBOARDING',
+    'template': 'onboarding_project.json',
+    'date': 'start',
+    'window_closes_days': '0',
+    'due_date': 'start',
+    'skip_locked': 'yes',
+    'placeholder_prefix': 'NEW_USER_',
+    'keys': 'employeeType o',
+    'description': '\n'.join([
+      '* Name: NEW_USER_NAME (NEW_USER_UID)',
+      '* Private email: NEW_USER_PRIVATE_MAIL',
+      '* Private phone: NEW_USER_PRIVATE_PHONE',
+      '* Work email: NEW_USER_WORK_MAIL',
+      '* Company: NEW_USER_COMPANY',
+      '* Title: NEW_USER_TITLE',
+      '* Start date: NEW_USER_START_DATE',
+      '* End date: NEW_USER_END_DATE',
+      '* Type: NEW_USER_TYPE',
+      '* People manager: NEW_USER_MANAGER_NAME',
+      ]),
+    },
+  'rule:offboarding': {
+    'identifier_prefix': 'OFFBOARDING',
+    'template': 'offboarding_project.json',
+    'date': 'end',
+    'window_opens_days': 'employee:28 hours:28 freelancer:7',
+    'due_date': 'end',
+    'skip_locked': 'no',
+    'placeholder_prefix': 'USER_',
+    'keys': 'employeeType o',
+    'description': '\n'.join([
+      '* Name: USER_NAME (USER_UID)',
+      '* Private email: USER_PRIVATE_MAIL',
+      '* Work email: USER_WORK_MAIL',
+      '* Company: USER_COMPANY',
+      '* Title: USER_TITLE',
+      '* Start date: USER_START_DATE',
+      '* End date: USER_END_DATE',
+      '* Type: USER_TYPE',
+      '* People manager: USER_MANAGER_NAME',
+      ]),
+    },
+  'rule:my_tasks': {
+    'identifier_prefix': 'MYTASKS',
+    'template': 'my_tasks_project.json',
+    'due_date': 'start',
+    'due_date_not_before_today': 'yes',
+    'project_owner': 'uid',
+    'skip_locked': 'yes',
+    'placeholder_prefix': 'USER_',
+    'keys': 'employeeType o',
+    },
+  }
+
+
+class Rule:
+  '''
+  A lifecycle project type read from a section '[rule:<name>]'
+  in the configuration file.
+
+  identifier_prefix: Prefix of the project identifier. The users
+  uidNumber is appended.
+
+  template: The JSON file describing the project.
+
+  description: The project description. May hold placeholders.
+  If not set, the description from the template is used.
+
+  date: The user date the window is relative to ('start' or 'end').
+  If not set, the window is always open. Users without the date are ignored.
+
+  window_opens_days: The window opens when less than days + 1 days are
+  left until 'date', i.e. 29 days before for 28 days. Either an
+  integer, or 'employeeType:days' pairs. Users of other types are ignored.
+  If not set, the window is open until it closes.
+
+  window_closes_days: Days before 'date' the window closes.
+  If not set, the window never closes.
+
+  due_date: The user date used as project due date ('start' or 'end').
+
+  due_date_not_before_today: If yes, the due date is today if 'due_date'
+  is in the past.
+
+  project_owner: If 'uid', the user owns the project. If not set, the
+  owner is read from the template.
+
+  skip_locked: If yes, users locked in LDAP are ignored.
+
+  placeholder_prefix: Prefix of the placeholders of the user values,
+  as in 'NEW_USER_NAME'.
+
+  keys: LDAP attributes used as keys for matching tasks.
+
+  golden: If yes, projects are created by copying tasks from a hidden
+  golden project built from the template.
+
+  reconcile: If yes, changes in the template are applied to existing
+  projects of the rule.
+  '''
+
+  def __init__(self, name, section):
+
+    self.name = name
+    self.identifier_prefix = section.get('identifier_prefix')
+    self.template = section.get('template')
+    self.description = section.get('description', '').strip() or None
+    self.date = section.get('date', None)
+    self.window_opens_days = parse_days(section.get('window_opens_days', None))
+    self.window_closes_days = parse_days(section.get('window_closes_days', None))
+    self.due_date = section.get('due_date', None)
+    self.due_date_not_before_today = section.getboolean(
+      'due_date_not_before_today', False)
+    self.project_owner = section.get('project_owner', None)
+    self.skip_locked = section.getboolean('skip_locked', True)
+    self.placeholder_prefix = section.get('placeholder_prefix', '')
+    self.keys = section.get('keys', '').split()
+    self.golden = section.getboolean('golden', False)
+    self.reconcile = section.getboolean('reconcile', False)
+
+  def window(self, values, today):
+    '''
+    Evaluates the rule for a user on date 'today'.
+
+    values: The user values as returned by user_values()
+
+    Returns tuple (is_open, next_date). is_open is True if the project
+    should exist today. next_date is the date the window opens if it opens
+    after today, else None.
+    '''
+    # Ignore locked users
+    if self.skip_locked and values['locked']:
+      return (False, None)
+
+    # Without a date, the window is always open
+    if not self.date:
+      return (True, None)
+
+    # Windows relative to a missing date never open
+    date = values['dates'].get(self.date)
+    if not date:
+      return (False, None)
+
+    if self.window_closes_days is not None:
+      days = self.days(self.window_closes_days, values)
+      if days is None:
+        return (False, None)
+      if today >= date - timedelta(days=days):
+        return (False, None)
+
+    if self.window_opens_days is not None:
+      days = self.days(self.window_opens_days, values)
+      if days is None:
+        return (False, None)
+      # As the sync always did, which compared '(date - now).days <= days'
+      # with the time of day in now
+      opens = date - timedelta(days=days + 1)
+      if today < opens:
+        return (False, opens)
+
+    return (True, None)
+
+  def days(self, days, values):
+    '''
+    Returns days from an integer or a dict with days by user type
+    '''
+    if isinstance(days, int):
+      return days
+
+    if values['type'] not in days:
+      logging.error("User type '%s' for user '%s' is undefined in rule '%s'",
+        values['type'], values['uid'], self.name)
+      return None
+
+    return days[values['type']]
+
+  def identifier(self, values):
+    '''
+    Returns the project identifier for a user
+    '''
+    return self.identifier_prefix + values['uid_number']
+
+  def is_identifier(self, identifier):
+    '''
+    Returns True if identifier is a project identifier of the rule
+    '''
+    if not identifier or not identifier.startswith(self.identifier_prefix):
+      return False
+
+    return identifier[len(self.identifier_prefix):].isdigit()
+
+  def placeholders(self, values):
+    '''
+    Returns dict with the placeholders for a user
+    '''
+    return {
+      self.placeholder_prefix + k: v
+      for k, v in values['placeholders'].items()
+      }
+
+  def project_due_date(self, values, today):
+    '''
+    Returns the project due date for a user
+    '''
+    d = values['dates'].get(self.due_date)
+
+    if self.due_date_not_before_today and (d is None or d < today):
+      d = today
+
+    return d
+
+
+def parse_days(value):
+  '''
+  Parses days as an integer ('7') or as pairs by user type
+  ('employee:28 freelancer:7').
+
+  Returns None, int or dict
+  '''
+  if value is None or value.strip() == '':
+    return None
+
+  if ':' not in value:
+    return int(value)
+
+  days = {}
+  for pair in value.replace(',', ' ').split():
+    user_type, d = pair.split(':')
+    days[user_type] = int(d)
+
+  return days
+
+
+def apply_json_section(config):
+  '''
+  Maps the options in section 'json' of configuration files from before
+  the rules ('onboarding: <file>', ...) onto the templates of the rules
+  with the same names. A template set in the section of the rule wins.
+  '''
+  if not config.has_section('json'):
+    return
+
+  for name, template in config.items('json', raw = True):
+    section = 'rule:' + name
+
+    if not config.has_section(section):
+      logging.warning("Option '%s' in section [json] matches no rule. Ignored.", name)
+      continue
+
+    # The template was set in the section of the rule
+    if config.get(section, 'template', raw = True, fallback = None) != \
+      DEFAULT_CONFIG.get(section, {}).get('template'):
+      logging.warning("Template of rule '%s' set in both [json] and [%s]. Using '%s'.",
+        name, section, config.get(section, 'template', raw = True))
+      continue
+
+    logging.warning("Section [json] is deprecated. Set 'template: %s' in section [%s].",
+      template, section)
+    config.set(section, 'template', template)
+
+
+def load_rules(config):
+  '''
+  Returns list of Rule objects for the rules named in option
+  'rules' in section 'lifecycle' of the configparser 'config'
+  '''
+  return [
+    Rule(name, config['rule:' + name])
+    for name in config.get('lifecycle', 'rules').split()
+    ]
+
+
+def rules_checksum(config):
+  '''
+  Returns a checksum of the options deciding when the projects are due:
+  Section 'lifecycle' and the sections of the rules in use. Tells when
+  the scheduled dates of the users are outdated.
+  '''
+  sections = ['lifecycle'] + [
+    'rule:' + name for name in config.get('lifecycle', 'rules').split()
+    ]
+
+  return hashlib.sha1(repr([
+    (section, sorted(config.items(section, raw = True)))
+    for section in sections if config.has_section(section)
+    ]).encode()).hexdigest()
+
+
+def user_values(u, ldap_users_by_uid):
+  '''
+  Derives the values used by the rules from the LDAP user 'u'
+  (ldap_users.User). Done once per user and shared by all rules.
+
+  Returns dict
+  '''
+
+  # The users start and end dates
+  start = u.start
+  end = u.end
+
+  placeholders = {
+    'NAME': u.cn or '',
+    'UID': u.uid,
+    'TITLE': u.title or '',
+    'TYPE': u.type or '',
+    'COMPANY': u.company or '',
+    'START_DATE': start.strftime('%d-%m-%Y') if start else "None",
+    'END_DATE': end.strftime('%d-%m-%Y') if end else "None",
+    'PRIVATE_MAIL': u.private_mail or '',
+    'WORK_MAIL': u.mail or '',
+    'EMAIL': u.mail or '',
+    'PRIVATE_PHONE': str(u.phone),
+    }
+
+  if u.manager_uid in ldap_users_by_uid:
+    placeholders['MANAGER_NAME'] = ldap_users_by_uid[u.manager_uid].cn or ''
+
+  return {
+    'uid': u.uid,
+    'uid_number': u.uid_number,
+    'cn': u.cn,
+    'type': u.type,
+    'locked': u.locked,
+    'dates': {'start': start, 'end': end},
+    'manager_uid': u.manager_uid,
+    'attributes': u.attributes,
+    'placeholders': placeholders,
+    }
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import collections
+import contextlib
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import time
+
+
+# From Python 3.12, cProfile uses sys.monitoring. One profiler then sees
+# all threads, and only one may be enabled at a time.
+PROFILER_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Profiler:
+  '''
+  Collects wall clock and CPU time of the phases of a run, of single
+  projects and of Kanboard API methods, and optionally a cProfile
+  capture of all threads.
+
+  A disabled profiler does nothing, so the timers can stay in the code.
+
+  enabled: If False, nothing is collected
+
+  output: If set, a cProfile capture is written to this file (pstats
+  format, as read by 'python -m pstats' or snakeviz)
+  '''
+
+  def __init__(self, enabled = False, output = None):
+    self.enabled = enabled or bool(output)
+    self.output = output
+
+    # (wall, cpu) seconds by kind ('phase', 'project', 'api') and name
+    self.timings = collections.defaultdict(lambda: collections.defaultdict(list))
+
+    # The cProfile captures of all threads
+    self.profiles = []
+
+    # Number of captures running
+    self.active = 0
+
+    # Timings are recorded from several threads
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def timer(self, kind, name, cpu_clock = time.thread_time):
+    '''
+    Times the block. CPU time is of the current thread, unless another
+    clock is given (e.g. time.process_time for phases run by threads).
+    '''
+    if not self.enabled:
+      yield
+      return
+
+    wall = time.perf_counter()
+    cpu = cpu_clock()
+
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.timings[kind][name].append(
+          (time.perf_counter() - wall, cpu_clock() - cpu))
+
+  def phase(self, name):
+    '''
+    Times a phase of the run. CPU time is of all threads.
+    '''
+    return self.timer('phase', name, time.process_time)
+
+  @contextlib.contextmanager
+  def capture(self):
+    '''
+    Runs the block with cProfile if an output file is set. Used once
+    per thread, as cProfile only profiles the thread it is enabled in.
+    From Python 3.12 the first capture profiles all threads, and the
+    captures started while it runs do nothing.
+    '''
+    if not self.output:
+      yield
+      return
+
+    profile = cProfile.Profile()
+
+    with self.lock:
+      if PROFILER_SEES_ALL_THREADS and self.active:
+        profile = None
+      else:
+        try:
+          profile.enable()
+          self.active += 1
+        except ValueError as e:
+          # Another profiler is enabled
+          logging.debug("Not profiling thread %s: %s",
+            threading.current_thread().name, e)
+          profile = None
+
+    if profile is None:
+      yield
+      return
+
+    try:
+      yield
+    finally:
+      profile.disable()
+      with self.lock:
+        self.active -= 1
+        self.profiles.append(profile)
+
+  def report(self, top = 10):
+    '''
+    Returns the report as a string: The phases in order, and the top
+    slowest projects and API methods
+    '''
+    lines = []
+
+    def table(title, timings, order = None):
+      lines.append('')
+      lines.append(title)
+      lines.append('  {:<48} {:>6} {:>10} {:>10} {:>10}'.format(
+        'Name', 'Calls', 'Wall', 'CPU', 'Max wall'))
+
+      rows = [
+        (name, len(t), sum(w for w, c in t), sum(c for w, c in t), max(w for w, c in t))
+        for name, t in timings.items()
+        ]
+      if order != 'insertion':
+        rows = sorted(rows, key = lambda r: r[2], reverse = True)[:top]
+
+      for name, calls, wall, cpu, max_wall in rows:
+        lines.append('  {:<48} {:>6} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+          str(name)[:48], calls, wall, cpu, max_wall))
+
+    with self.lock:
+      table('Phases (CPU of all threads)', self.timings['phase'], 'insertion')
+      table('Top {} slowest projects'.format(top), self.timings['project'])
+      table('Top {} slowest API methods'.format(top), self.timings['api'])
+
+    return '\n'.join(lines)
+
+  def write(self, top = 10):
+    '''
+    Logs the report, and writes the cProfile capture (If any)
+    '''
+    if not self.enabled:
+      return
+
+    logging.info("Profile:%s", self.report(top))
+
+    if self.profiles:
+      with self.lock:
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+          stats.add(profile)
+      stats.dump_stats(self.output)
+      logging.info("Wrote profile of %s threads to '%s'",
+        len(self.profiles), self.output)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+
+
+# Valid user roles in a Kanboard project
+KANBOARD_ROLES = (
+  'project-member',
+  'project-viewer',
+  'project-manager'
+  )
+
+# Colors of Kanboard tasks
+KANBOARD_COLORS = (
+  'yellow', 'blue', 'green', 'purple', 'red', 'orange', 'grey', 'brown',
+  'deep_orange', 'dark_grey', 'pink', 'teal', 'cyan', 'lime',
+  'light_green', 'amber'
+  )
+
+# Number of columns on a new Kanboard board
+DEFAULT_COLUMNS = 4
+
+# Loaded templates by file. See load()
+_templates_by_file = {}
+
+# Templates may be loaded from several threads
+_lock = threading.Lock()
+
+
+class TemplateError(Exception):
+  '''
+  Raised when a template is invalid
+  '''
+  pass
+
+
+class Template:
+  '''
+  A JSON file describing a project, parsed and validated once.
+
+  path: The JSON file
+
+  raw: The content of the file (bytes)
+
+  checksum: SHA1 of the content. Tells when projects must be reconciled.
+
+  data: The parsed project. Must not be changed.
+
+  task_ids: The ids of the tasks (See template_task_ids())
+
+  legacy_task_ids: The ids tasks were tagged with before tasks had
+  ids (See legacy_task_ids())
+
+  errors: List of problems making the template unusable
+
+  warnings: List of problems worth knowing about
+  '''
+
+  def __init__(self, path, raw):
+    self.path = path
+    self.raw = raw
+    self.checksum = hashlib.sha1(raw).hexdigest()
+    self.data = None
+    self.task_ids = []
+    self.legacy_task_ids = []
+    self.errors = []
+    self.warnings = []
+
+    try:
+      self.data = json.loads(raw.decode())
+    except ValueError as e:
+      self.errors.append("Not valid JSON: {}".format(e))
+      return
+
+    validate(self.data, self.errors, self.warnings)
+
+    if not self.errors:
+      self.task_ids = template_task_ids(self.data['tasks'])
+      self.legacy_task_ids = legacy_task_ids(self.data['tasks'])
+
+  def roles(self):
+    '''
+    Returns set of the roles (e.g. 'ROLE_MANAGER') used as task owners
+    '''
+    if self.errors:
+      return set()
+
+    return set([
+      t['owner'].upper() for t in self.data['tasks']
+      if t['owner'].upper().startswith('ROLE_')
+      ])
+
+  def has_task_ids(self):
+    '''
+    Returns True if all tasks have an id (Field 'id')
+    '''
+    if self.errors:
+      return False
+
+    return all(['id' in t for t in self.data['tasks']])
+
+  def keys(self):
+    '''
+    Returns set of the task keys in the template (Lowercase)
+    '''
+    if self.errors:
+      return set()
+
+    return set([k.lower() for t in self.data['tasks'] for k in t.get('keys', [])])
+
+
+def load(project_file):
+  '''
+  Returns the Template in the JSON file project_file. Templates are
+  cached until the file changes.
+
+  Raises OSError if the file can not be read
+  '''
+  stat = os.stat(project_file)
+  version = (stat.st_mtime_ns, stat.st_size)
+
+  with _lock:
+    cached = _templates_by_file.get(project_file)
+    if cached and cached[0] == version:
+      return cached[1]
+
+    with open(project_file, 'rb') as f:
+      template = Template(project_file, f.read())
+
+    for warning in template.warnings:
+      logging.warning("Template '%s': %s", project_file, warning)
+
+    _templates_by_file[project_file] = (version, template)
+
+    return template
+
+
+def check(project_file):
+  '''
+  Returns the valid Template in project_file.
+
+  Raises TemplateError if the template is invalid or can not be read
+  '''
+  try:
+    template = load(project_file)
+  except OSError as e:
+    raise TemplateError("Template '{}': {}".format(project_file, e)) from e
+
+  if template.errors:
+    raise TemplateError("Template '{}' is invalid: {}".format(
+      project_file, '; '.join(template.errors)))
+
+  return template
+
+
+def validate(data, errors, warnings):
+  '''
+  Checks the parsed template data. Problems are appended to the lists
+  errors and warnings.
+  '''
+  if not isinstance(data, dict):
+    errors.append("The template must be a JSON object")
+    return
+
+  for field in ('title', 'description', 'owner'):
+    if field in data and not isinstance(data[field], str):
+      errors.append("'{}' must be a string".format(field))
+
+  if not data.get('title'):
+    warnings.append("No 'title'. The title must be given when creating projects.")
+
+  # Project members
+  if not isinstance(data.get('users', []), list):
+    errors.append("'users' must be a list")
+  else:
+    for i, u in enumerate(data.get('users', [])):
+      where = "User {}".format(i + 1)
+      if not isinstance(u, dict) or not isinstance(u.get('name'), str) or not u['name']:
+        errors.append("{}: 'name' is missing".format(where))
+        continue
+      if u.get('role') not in KANBOARD_ROLES:
+        errors.append("{} ('{}'): 'role' must be one of {}".format(
+          where, u['name'], ', '.join(KANBOARD_ROLES)))
+      if u['name'].upper().startswith('ROLE_'):
+        warnings.append("{}: Roles like '{}' are not mapped to users in 'users'".format(
+          where, u['name']))
+
+  # Tasks
+  if not isinstance(data.get('tasks'), list):
+    errors.append("'tasks' must be a list")
+    return
+
+  task_ids = collections.Counter()
+  without_id = 0
+
+  for i, t in enumerate(data['tasks']):
+
+    if not isinstance(t, dict):
+      errors.append("Task {}: Must be a JSON object".format(i + 1))
+      continue
+
+    where = "Task {} ('{}')".format(i + 1, t.get('title', ''))
+
+    if not isinstance(t.get('title'), str) or not t['title'].strip():
+      errors.append("{}: 'title' is missing".format(where))
+
+    if not isinstance(t.get('description', ''), str):
+      errors.append("{}: 'description' must be a string".format(where))
+
+    # Owner is a username, a group name or a role. Empty for the project owner.
+    if 'owner' not in t:
+      errors.append("{}: 'owner' is missing. Use \"\" for the project owner.".format(where))
+    elif not isinstance(t['owner'], str):
+      errors.append("{}: 'owner' must be a string".format(where))
+
+    # Days relative to the project due date
+    due_date = t.get('due_date', '')
+    if isinstance(due_date, bool) or not isinstance(due_date, (int, str)):
+      errors.append("{}: 'due_date' must be an integer".format(where))
+    elif isinstance(due_date, str) and due_date.strip():
+      try:
+        int(due_date)
+      except ValueError:
+        errors.append("{}: 'due_date' must be an integer, not '{}'".format(where, due_date))
+
+    # Column position on the board
+    column = str(t.get('column', '1'))
+    if not column.isdigit() or int(column) < 1:
+      errors.append("{}: 'column' must be a column position (1, 2, ...), not '{}'".format(
+        where, column))
+    elif int(column) > DEFAULT_COLUMNS:
+      warnings.append("{}: Column {} is not on a default board. Column 1 is used if missing.".format(
+        where, column))
+
+    if t.get('color') and t['color'] not in KANBOARD_COLORS:
+      warnings.append("{}: Unknown color '{}'".format(where, t['color']))
+
+    for field in ('tags', 'keys'):
+      values = t.get(field, [])
+      if not isinstance(values, list) or \
+        not all(isinstance(v, str) and v.strip() for v in values):
+        errors.append("{}: '{}' must be a list of names".format(where, field))
+
+    # Links need a title and a web address
+    if not isinstance(t.get('links', []), list):
+      errors.append("{}: 'links' must be a list".format(where))
+    else:
+      for l in t.get('links', []):
+        if not isinstance(l, dict) or not l.get('title'):
+          errors.append("{}: Link without 'title'".format(where))
+          continue
+        url = urllib.parse.urlsplit(str(l.get('url') or ''))
+        if url.scheme not in ('http', 'https') or not url.netloc:
+          errors.append("{}: Link '{}' has no valid 'url'".format(where, l['title']))
+
+    if not isinstance(t.get('subtasks', []), list):
+      errors.append("{}: 'subtasks' must be a list".format(where))
+    else:
+      for st in t.get('subtasks', []):
+        if not isinstance(st, dict) or not isinstance(st.get('title'), str) \
+          or not st['title'].strip():
+          errors.append("{}: Subtask without 'title'".format(where))
+
+    # The id matches the task with the tasks of existing projects, so
+    # titles and keys may be changed without losing the tasks progress.
+    # Without an id, the title and keys are the id (See legacy_task_ids()).
+    if 'id' not in t:
+      without_id += 1
+    elif isinstance(t['id'], bool) or not isinstance(t['id'], (int, str)) \
+      or not str(t['id']).strip():
+      errors.append("{}: 'id' must be a number or a non-empty string".format(where))
+    else:
+      task_ids[str(t['id'])] += 1
+
+  if without_id:
+    warnings.append("{} tasks have no 'id'. Changing their title or keys gives new tasks. Give every task a unique id, e.g. \"onboarding-01\".".format(
+      without_id))
+
+  # Ids must be unique, or projects can not be reconciled
+  for task_id, n in task_ids.items():
+    if n > 1:
+      errors.append("Task id '{}' is used by {} tasks".format(task_id, n))
+
+
+def template_task_ids(tasks):
+  '''
+  Returns list of the ids (Field 'id', as string) of the list of tasks
+  from a JSON file. Ids must be unique (See validate()). Tasks without
+  an id get their legacy id (See legacy_task_ids()).
+  '''
+  return [
+    str(t['id']) if 'id' in t else legacy_id
+    for t, legacy_id in zip(tasks, legacy_task_ids(tasks))
+    ]
+
+
+def legacy_task_ids(tasks):
+  '''
+  Returns list of the ids of tasks without an id, as projects were
+  tagged before tasks had ids: A checksum of the title and keys as written in the JSON
+  file, with a running number for tasks with the same title and keys.
+
+  Used for matching the tasks of projects created back then, and for
+  tasks without an id. Any change to the title or keys gives a new id.
+  '''
+  ids = []
+  seen = collections.Counter()
+
+  for t in tasks:
+    task_id = hashlib.sha1('\n'.join(
+      [t.get('title', '')] + sorted(t.get('keys', []))
+      ).encode()).hexdigest()[:12]
+
+    # Make ids unique
+    n = seen[task_id]
+    seen[task_id] += 1
+    ids.append(task_id if n == 0 else '{}-{}'.format(task_id, n))
+
+  return ids
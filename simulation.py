@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import collections
+from datetime import date, timedelta
+import json
+import math
+
+import json2kanboard
+import kanboard_client
+import ldap_users
+import lifecycle
+import project_template
+
+
+class Day:
+  '''
+  What a sync would do on one day.
+
+  date: The day (datetime.date)
+
+  projects: Projects created by rule name (collections.Counter)
+
+  counts: Tasks, subtasks and links created, JSON-RPC calls (One per
+  procedure, also in a batch) and HTTP requests (One per batch of up to
+  kanboard_client.BATCH_SIZE calls) (collections.Counter)
+
+  max_batch: Calls in the largest batch sent
+  '''
+
+  def __init__(self, day):
+    self.date = day
+    self.projects = collections.Counter()
+    self.counts = collections.Counter()
+    self.max_batch = 0
+
+    # Looked up once per run and shared by all projects
+    self.groups_listed = False
+    self.groups_fetched = set()
+    self.workload_built = False
+    self.tags_listed = False
+    self.golden_templates = set()
+
+  def single(self, calls = 1):
+    '''
+    Counts calls sent one request each
+    '''
+    self.counts['calls'] += calls
+    self.counts['requests'] += calls
+
+  def batch(self, calls):
+    '''
+    Counts a batch of calls
+    '''
+    self.counts['calls'] += calls
+    self.counts['requests'] += batch_requests(calls)
+    self.max_batch = max(self.max_batch, calls)
+
+
+def save_snapshot(filename, users, projects, group_names, taken):
+  '''
+  Writes the directory as seen by a sync to the JSON file filename.
+
+  users: List of ldap_users.User
+
+  projects: List of all Kanboard projects (dicts)
+
+  group_names: The names of the Kanboard groups
+
+  taken: The date of the snapshot
+  '''
+  data = {
+    'taken': taken.isoformat(),
+    'users': [
+      dict(u._asdict(),
+        start = u.start.isoformat() if u.start else None,
+        end = u.end.isoformat() if u.end else None)
+      for u in users
+      ],
+    'project_identifiers': sorted([
+      p['identifier'] for p in projects if p.get('identifier')
+      ]),
+    'active_project_identifiers': sorted([
+      p['identifier'] for p in projects
+      if p.get('identifier') and int(p.get('is_active', 1)) == 1
+      ]),
+    'active_projects': len([
+      p for p in projects if int(p.get('is_active', 1)) == 1
+      ]),
+    'groups': sorted(group_names),
+    }
+
+  with open(filename, 'w') as f:
+    json.dump(data, f, indent = 1)
+
+
+def load_snapshot(filename):
+  '''
+  Reads a snapshot written by save_snapshot()
+
+  Returns dict with users (List of ldap_users.User), project_identifiers,
+  active_project_identifiers and groups (Sets), active_projects (Number
+  of active projects) and taken (datetime.date)
+  '''
+  with open(filename) as f:
+    data = json.load(f)
+
+  users = [
+    ldap_users.User(**dict(u,
+      start = date.fromisoformat(u['start']) if u['start'] else None,
+      end = date.fromisoformat(u['end']) if u['end'] else None))
+    for u in data['users']
+    ]
+
+  # Snapshots from before archived projects and groups were recorded
+  active_project_identifiers = data.get('active_project_identifiers',
+    data['project_identifiers'])
+
+  return {
+    'users': users,
+    'project_identifiers': set(data['project_identifiers']),
+    'active_project_identifiers': set(active_project_identifiers),
+    'active_projects': data.get('active_projects', len(active_project_identifiers)),
+    'groups': set(data.get('groups', [])),
+    'taken': date.fromisoformat(data['taken']),
+    }
+
+
+def batch_requests(calls):
+  '''
+  Returns the number of requests for a batch of calls
+  '''
+  return math.ceil(calls / kanboard_client.BATCH_SIZE)
+
+
+def count_project(day, rule, values, template, group_names, active_projects,
+  global_tags = False):
+  '''
+  Counts what json2kanboard.create_project() sends for a project of the
+  rule for a user, including the lookups shared by the projects of a run
+  (Groups, open tasks, global tags and golden projects) the first time
+  they are needed. Owners added to a project on the fly depend on the
+  project members in Kanboard, and global tags and golden projects are
+  assumed to exist, so these are not counted.
+
+  values: The user values as returned by lifecycle.user_values()
+
+  template: The project_template.Template of the rule
+
+  group_names: The names of the Kanboard groups
+
+  active_projects: The number of active projects, for the open tasks
+  fetched by json2kanboard.WorkloadIndex
+  '''
+  keys = [values['attributes'][a] for a in rule.keys]
+  placeholders = rule.placeholders(values)
+
+  roles = {}
+  if values['manager_uid']:
+    roles['ROLE_MANAGER'] = values['manager_uid']
+
+  # The tasks of the template matching the users keys
+  tasks = [
+    t for t in template.data['tasks'] if json2kanboard.task_matches_keys(t, keys)
+    ]
+  subtasks = sum([len(t.get('subtasks', [])) for t in tasks])
+  links = sum([len(t.get('links', [])) for t in tasks])
+
+  day.counts.update(tasks = len(tasks), subtasks = subtasks, links = links)
+
+  # Users, identifier, project, columns, members and assignable users.
+  # Roles in 'users' are not Kanboard users, so they are not added.
+  day.single(5 + len([
+    u for u in template.data.get('users', [])
+    if not u['name'].upper().startswith('ROLE_')
+    ]))
+
+  # Global tags are listed once per run
+  tags = set([tag for t in tasks for tag in t.get('tags', [])])
+  if global_tags and tags and not rule.golden and not day.tags_listed:
+    day.tags_listed = True
+    day.single()
+
+  # The groups owning tasks. Listed once, and the members of each group
+  # fetched once per run.
+  owners = [
+    roles.get(t['owner'].upper(), t['owner'])
+    if 'ROLE_' in t['owner'].upper() else t['owner']
+    for t in tasks if t['owner']
+    ]
+  groups = set(owners) & set(group_names)
+
+  if not day.groups_listed:
+    day.groups_listed = True
+    day.single()
+
+  if groups - day.groups_fetched:
+    day.batch(len(groups - day.groups_fetched))
+    day.groups_fetched |= groups
+
+  # The open tasks of all projects are counted when a group gets a task
+  if groups and not day.workload_built:
+    day.workload_built = True
+    day.batch(active_projects)
+
+  if rule.golden:
+
+    # The golden project is looked up once per run
+    if rule.template not in day.golden_templates:
+      day.golden_templates.add(rule.template)
+      day.single(2)
+
+    # Subtasks with placeholders are updated after the copy
+    placeholder_subtasks = [
+      [st for st in t.get('subtasks', [])
+        if json2kanboard.process_placeholders(st['title'], placeholders) != st['title']]
+      for t in tasks
+      ]
+
+    # Copy tasks, update tasks and links, and update subtasks
+    day.batch(len(tasks))
+    day.batch(len(tasks) + links + len([s for s in placeholder_subtasks if s]))
+    day.batch(sum([len(s) for s in placeholder_subtasks]))
+
+  else:
+    day.single(len(tasks) + subtasks + links)
+
+  # Metadata of the tasks and the project
+  day.batch(len(tasks) + 1)
+
+
+def simulate(rules, snapshot, first_day, last_day, housekeeping_rules = [],
+  global_tags = False):
+  '''
+  Replays the lifecycle decisions of the sync day by day, without any
+  Kanboard requests. Every user is evaluated every day, which creates
+  the same projects as a sync only handling due and changed users.
+
+  Every day counts a full run: The Kanboard users and projects, the
+  metadata of the projects of rules with reconcile, the projects
+  created (See count_project()) and the tasks and end dates of the
+  housekeeping projects. Projects archived by housekeeping are not simulated.
+
+  rules: List of lifecycle.Rule
+
+  snapshot: The snapshot as returned by load_snapshot(). Projects
+  created on a day exist the days after.
+
+  housekeeping_rules: The names of the rules in section 'housekeeping'
+
+  global_tags: True if tags are global (Section 'kanboard')
+
+  Returns list of Day, from first_day to last_day
+  '''
+  users = snapshot['users']
+  ldap_users_by_uid = { u.uid: u for u in users }
+
+  # Values shared by all rules and days (Dates, placeholders, ...)
+  values_by_uid = {
+    u.uid: lifecycle.user_values(u, ldap_users_by_uid)
+    for u in users if u.uid and u.uid_number
+    }
+
+  templates = {
+    rule.name: project_template.check(rule.template) for rule in rules
+    }
+
+  existing = set(snapshot['project_identifiers'])
+  active = set(snapshot['active_project_identifiers'])
+  active_projects = snapshot['active_projects']
+  days = []
+
+  # The uidNumbers of the users with an end date
+  end_uid_numbers = set([u.uid_number for u in users if u.end])
+
+  def rule_projects(rule_names):
+    return len([
+      identifier for identifier in active
+      if any(rule.is_identifier(identifier) for rule in rules if rule.name in rule_names)
+      ])
+
+  def housekeeping_calls():
+    calls = 0
+    for identifier in active:
+      for rule in rules:
+        if rule.name in housekeeping_rules and rule.is_identifier(identifier):
+
+          # Open and closed tasks, and the metadata of boards due on the
+          # end date of a user without one
+          calls += 2
+          if rule.due_date == 'end' and \
+            identifier[len(rule.identifier_prefix):] not in end_uid_numbers:
+            calls += 1
+          break
+    return calls
+
+  today = first_day
+  while today <= last_day:
+
+    day = Day(today)
+
+    # Kanboard users and projects
+    day.single(2)
+
+    # Metadata of the projects of rules with reconcile
+    day.batch(rule_projects([rule.name for rule in rules if rule.reconcile]))
+
+    # The housekeeping of the projects. The projects created today are
+    # not in the project list the run starts with.
+    housekeeping = housekeeping_calls()
+
+    for uid, values in values_by_uid.items():
+      for rule in rules:
+
+        is_open, _ = rule.window(values, today)
+        if not is_open:
+          continue
+
+        project_identifier = rule.identifier(values)
+        if project_identifier in existing:
+          continue
+
+        count_project(day, rule, values, templates[rule.name],
+          snapshot['groups'], active_projects, global_tags)
+        day.projects[rule.name] += 1
+
+        existing.add(project_identifier)
+        active.add(project_identifier)
+        active_projects += 1
+
+    day.batch(housekeeping)
+
+    days.append(day)
+    today += timedelta(days=1)
+
+  return days
+
+
+def report(days, rules):
+  '''
+  Returns the projected projects, tasks and requests per day as a
+  string, with totals and the busiest day
+  '''
+  names = [rule.name for rule in rules]
+  fields = ('tasks', 'subtasks', 'links', 'calls', 'requests')
+
+  lines = []
+  lines.append('{:<10} '.format('Date') +
+    ' '.join(['{:>12}'.format(n[:12]) for n in names]) + ' ' +
+    ' '.join(['{:>9}'.format(f.capitalize()) for f in fields]) +
+    ' {:>9}'.format('Max batch'))
+
+  def row(label, projects, counts, max_batch):
+    lines.append('{:<10} '.format(label) +
+      ' '.join(['{:>12}'.format(projects[n]) for n in names]) + ' ' +
+      ' '.join(['{:>9}'.format(counts[f]) for f in fields]) +
+      ' {:>9}'.format(max_batch))
+
+  for day in days:
+    row(day.date.isoformat(), day.projects, day.counts, day.max_batch)
+
+  if days:
+    row('Total',
+      sum([day.projects for day in days], collections.Counter()),
+      sum([day.counts for day in days], collections.Counter()),
+      max([day.max_batch for day in days]))
+
+    busiest = max(days, key = lambda day: day.counts['requests'])
+    lines.append('')
+    lines.append("Busiest day: {} with {} projects and {} requests".format(
+      busiest.date.isoformat(),
+      sum(busiest.projects.values()),
+      busiest.counts['requests']))
+
+  return '\n'.join(lines)
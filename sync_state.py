@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import heapq
+import json
+import logging
+import os
+import threading
+
+
+class SyncState:
+  '''
+  State kept between runs of ldap2kanboard.py.
+
+  The state holds a priority queue of (date, uid) pairs with the next
+  date a lifecycle action (onboarding, offboarding threshold, ...) is due
+  for a user, the LDAP modifyTimestamp last seen for every user, and a
+  checksum of the lifecycle rules the dates were scheduled by.
+  A run then only has to handle users whose time has come, and users
+  which are new or changed in LDAP.
+
+  state_file: The JSON file to load the state from and save it to.
+  If not set, nothing is loaded or saved, and every user is treated
+  as changed.
+  '''
+
+  def __init__(self, state_file = None):
+
+    self.state_file = state_file
+
+    # The next due date (ISO string) of every scheduled user by uid
+    self.next_action_by_uid = {}
+
+    # Heap of (ISO date, uid). May hold stale entries for rescheduled users
+    self.queue = []
+
+    # The LDAP modifyTimestamp (as string) of every known user by uid
+    self.modified_by_uid = {}
+
+    # Checksum of the rules the users were scheduled by. See rules_changed()
+    self.rules_checksum = None
+
+    # Users may be scheduled from several threads
+    self.lock = threading.Lock()
+
+    if state_file and os.path.exists(state_file):
+      self.load()
+
+  def load(self):
+    '''
+    Loads the state from the state file
+    '''
+    try:
+      with open(self.state_file) as f:
+        data = json.load(f)
+    except (OSError, ValueError) as e:
+      logging.error("Could not load state file '%s': %s", self.state_file, e)
+      return
+
+    self.next_action_by_uid = data.get('next_action', {})
+    self.modified_by_uid = data.get('modified', {})
+    self.rules_checksum = data.get('rules_checksum')
+
+    # Rebuild the queue from the due dates. Drops stale entries.
+    self.queue = [(d, uid) for uid, d in self.next_action_by_uid.items()]
+    heapq.heapify(self.queue)
+
+  def save(self):
+    '''
+    Saves the state to the state file (If any)
+    '''
+    if not self.state_file:
+      return
+
+    with self.lock:
+      data = {
+        'next_action': dict(self.next_action_by_uid),
+        'modified': dict(self.modified_by_uid),
+        'rules_checksum': self.rules_checksum
+        }
+
+    # Write to a temporary file first, so a crash never leaves half a state
+    tmp_file = self.state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+      json.dump(data, f, indent = 2, sort_keys = True)
+    os.replace(tmp_file, self.state_file)
+
+  def schedule(self, uid, date):
+    '''
+    Sets the next due date of user 'uid' to 'date' (datetime.date).
+    If date is None, the user is not scheduled.
+    '''
+    with self.lock:
+      if date is None:
+        self.next_action_by_uid.pop(uid, None)
+        return
+
+      d = date.isoformat()
+
+      # Nothing to do if the user is already scheduled for this date
+      if self.next_action_by_uid.get(uid) == d:
+        return
+
+      self.next_action_by_uid[uid] = d
+      heapq.heappush(self.queue, (d, uid))
+
+  def rules_changed(self, checksum):
+    '''
+    Returns True if the rules changed since the users were scheduled
+    (See lifecycle.rules_checksum()). The scheduled dates are then
+    outdated, and are dropped. The checksum is recorded for next run.
+    '''
+    with self.lock:
+      if self.rules_checksum == checksum:
+        return False
+
+      self.rules_checksum = checksum
+      self.next_action_by_uid = {}
+      self.queue = []
+
+      return True
+
+  def pop_due(self, today):
+    '''
+    Removes all users due on or before 'today' (datetime.date)
+    from the queue.
+
+    Returns set of uids
+    '''
+    today = today.isoformat()
+    due = set()
+
+    while self.queue and self.queue[0][0] <= today:
+      d, uid = heapq.heappop(self.queue)
+
+      # Ignore stale entries for users who were rescheduled
+      if self.next_action_by_uid.get(uid) != d:
+        continue
+
+      del self.next_action_by_uid[uid]
+      due.add(uid)
+
+    return due
+
+  def changed(self, uid, timestamp):
+    '''
+    Returns True if the user 'uid' is new, or has been modified
+    in LDAP since last run. The timestamp is recorded for next run.
+    Without a state file, all users are considered changed.
+    '''
+    timestamp = str(timestamp)
+    is_changed = self.modified_by_uid.get(uid) != timestamp
+    self.modified_by_uid[uid] = timestamp
+
+    return is_changed or not self.state_file
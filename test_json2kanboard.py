@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import unittest
+
+import kanboard
+
+import json2kanboard
+import project_template
+
+
+def template_tasks(*tasks):
+  '''
+  Returns dict of the template tasks (dicts) by id, as reconcile_project()
+  passes them to match_tasks()
+  '''
+  return {t['id']: t for t in tasks}
+
+
+class MatchTasksTest(unittest.TestCase):
+  '''
+  Tests json2kanboard.match_tasks()
+  '''
+
+  def test_unchanged(self):
+    wanted = template_tasks({'id': 'a', 'title': 'A'}, {'id': 'b', 'title': 'B'})
+    tasks = {'a': {'id': 1, 'title': 'A'}, 'b': {'id': 2, 'title': 'B'}}
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(wanted, tasks, {})
+
+    self.assertEqual(added, [])
+    self.assertEqual(removed, [])
+    self.assertEqual(sorted([i for i, _ in matched]), ['a', 'b'])
+    self.assertEqual(retagged, [])
+
+  def test_changed_title_keeps_task(self):
+    # The id is kept when the title is edited, so the task is updated
+    wanted = template_tasks({'id': 'a', 'title': 'A, edited'})
+    tasks = {'a': {'id': 1, 'title': 'A'}}
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(wanted, tasks, {})
+
+    self.assertEqual((added, removed, retagged), ([], [], []))
+    self.assertEqual(matched, [('a', tasks['a'])])
+
+  def test_added_and_removed(self):
+    wanted = template_tasks({'id': 'a', 'title': 'A'}, {'id': 'c', 'title': 'C'})
+    tasks = {
+      'a': {'id': 1, 'title': 'A'},
+      'b': {'id': 2, 'title': 'B', 'is_active': '1'},
+      'x': {'id': 3, 'title': 'X', 'is_active': '0'},
+      }
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(wanted, tasks, {})
+
+    self.assertEqual(added, ['c'])
+    # Closed tasks are kept
+    self.assertEqual(removed, [tasks['b']])
+    self.assertEqual(matched, [('a', tasks['a'])])
+    self.assertEqual(retagged, [])
+
+  def test_legacy_id_is_retagged(self):
+    # Projects created before tasks had ids are tagged with checksums
+    task = {'title': 'Send mail to USER_NAME', 'keys': ['employee']}
+    legacy_id = project_template.legacy_task_ids([task])[0]
+
+    wanted = template_tasks(dict(task, id = 'mail'))
+    tasks = {legacy_id: {'id': 1, 'title': 'Send mail to Jane', 'is_active': '1'}}
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(
+      wanted, tasks, {legacy_id: 'mail'})
+
+    self.assertEqual((added, removed), ([], []))
+    self.assertEqual(matched, [('mail', tasks[legacy_id])])
+    self.assertEqual(retagged, [('mail', tasks[legacy_id])])
+
+  def test_unknown_id_matched_by_title(self):
+    # A task tagged with an id gone from the template, but with the same title
+    wanted = template_tasks({'id': 'new', 'title': 'Welcome USER_NAME'})
+    tasks = {'old': {'id': 1, 'title': 'Welcome Jane', 'is_active': '1'}}
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(
+      wanted, tasks, {}, {'USER_NAME': 'Jane'})
+
+    self.assertEqual((added, removed), ([], []))
+    self.assertEqual(retagged, [('new', tasks['old'])])
+
+  def test_template_task_claimed_once(self):
+    # Two old tasks can not both become the same template task
+    wanted = template_tasks({'id': 'a', 'title': 'A'})
+    tasks = {
+      'a': {'id': 1, 'title': 'A', 'is_active': '1'},
+      'old': {'id': 2, 'title': 'A', 'is_active': '1'},
+      }
+
+    added, removed, matched, retagged = json2kanboard.match_tasks(wanted, tasks, {})
+
+    self.assertEqual(added, [])
+    self.assertEqual(removed, [tasks['old']])
+    self.assertEqual(matched, [('a', tasks['a'])])
+    self.assertEqual(retagged, [])
+
+
+class FakeKanboard:
+  '''
+  Kanboard client with one task tagged 'onboarding-01'. Methods in fail
+  raise kanboard.ClientError. All calls are recorded in calls.
+  '''
+
+  def __init__(self, fail = ()):
+    self.fail = fail
+    self.calls = []
+
+  def __getattr__(self, method):
+    def call(**params):
+      self.calls.append(method)
+      if method in self.fail:
+        raise kanboard.ClientError("{} failed".format(method))
+      if method == 'get_all_tasks':
+        return [{'id': 1, 'title': 'A', 'is_active': 1}] if params['status_id'] == 1 else []
+      if method == 'get_task_metadata_by_name':
+        return 'onboarding-01'
+      return True
+    return call
+
+
+class ReconcileProjectTest(unittest.TestCase):
+  '''
+  Tests json2kanboard.reconcile_project() with failing Kanboard calls
+  '''
+
+  def reconcile(self, kb):
+    return json2kanboard.reconcile_project('onboarding_project.json', kb, 1,
+      keys = ['employee', 'Kontrapunkt Copenhagen'])
+
+  def test_failed_task_list(self):
+    # Missing tasks must not be created again
+    kb = FakeKanboard(fail = ('get_all_tasks',))
+
+    self.assertFalse(self.reconcile(kb))
+    self.assertEqual(set(kb.calls), set(['get_all_tasks']))
+
+  def test_failed_template_task(self):
+    # The project must not be marked as untagged
+    kb = FakeKanboard(fail = ('get_task_metadata_by_name',))
+
+    self.assertFalse(self.reconcile(kb))
+    self.assertNotIn('save_project_metadata', kb.calls)
+    self.assertNotIn('create_task', kb.calls)
+
+
+class TemplateTaskIdsTest(unittest.TestCase):
+  '''
+  Tests the task ids checked by project_template.validate()
+  '''
+
+  def test_missing_id_is_a_warning(self):
+    # Templates written before tasks had ids still work
+    errors = []
+    warnings = []
+    tasks = [{'title': 'A', 'owner': ''}, {'id': 'b', 'title': 'B', 'owner': ''}]
+    project_template.validate({'title': 'T', 'tasks': tasks}, errors, warnings)
+
+    self.assertEqual(errors, [])
+    self.assertTrue(any("1 tasks have no 'id'" in w for w in warnings))
+
+    # The task without id keeps the id it was tagged with back then
+    self.assertEqual(project_template.template_task_ids(tasks),
+      [project_template.legacy_task_ids(tasks)[0], 'b'])
+
+  def test_invalid_id_is_an_error(self):
+    errors = []
+    project_template.validate(
+      {'title': 'T', 'tasks': [{'id': True, 'title': 'A', 'owner': ''}]}, errors, [])
+
+    self.assertEqual(len(errors), 1)
+
+  def test_duplicate_id_is_an_error(self):
+    errors = []
+    project_template.validate({'title': 'T', 'tasks': [
+      {'id': 'a', 'title': 'A', 'owner': ''},
+      {'id': 'a', 'title': 'B', 'owner': ''},
+      ]}, errors, [])
+
+    self.assertEqual(errors, ["Task id 'a' is used by 2 tasks"])
+
+  def test_shipped_templates_are_valid(self):
+    for f in ('onboarding_project.json', 'offboarding_project.json',
+      'my_tasks_project.json', 'kanboard_project.demo.json'):
+      self.assertEqual(project_template.load(f).errors, [], f)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+import configparser
+from datetime import date
+import unittest
+
+import lifecycle
+
+
+def default_rules():
+  '''
+  Returns dict of the default rules (lifecycle.Rule) by name
+  '''
+  config = configparser.ConfigParser()
+  config.read_dict(lifecycle.DEFAULT_CONFIG)
+
+  return {rule.name: rule for rule in lifecycle.load_rules(config)}
+
+
+def values(user_type = 'employee', start = None, end = None, locked = False):
+  '''
+  Returns user values as returned by lifecycle.user_values()
+  '''
+  return {
+    'uid': 'jane',
+    'uid_number': 1000,
+    'cn': 'Jane',
+    'type': user_type,
+    'locked': locked,
+    'dates': {'start': start, 'end': end},
+    'manager_uid': None,
+    'attributes': {},
+    'placeholders': {},
+    }
+
+
+class RuleWindowTest(unittest.TestCase):
+  '''
+  Tests lifecycle.Rule.window() with the default rules
+  '''
+
+  def setUp(self):
+    self.rules = default_rules()
+
+  def test_offboarding_opens_as_before(self):
+    # The sync opened the window when '(end - now).days <= 28'. With
+    # the time of day in now, that is 29 days before the end date.
+    offboarding = self.rules['offboarding']
+    v = values(end = date(2027, 3, 10))
+
+    self.assertEqual(offboarding.window(v, date(2027, 2, 8)), (False, date(2027, 2, 9)))
+    self.assertEqual(offboarding.window(v, date(2027, 2, 9)), (True, None))
+    self.assertEqual(offboarding.window(v, date(2027, 3, 10)), (True, None))
+
+  def test_offboarding_days_by_type(self):
+    offboarding = self.rules['offboarding']
+    v = values(user_type = 'freelancer', end = date(2027, 3, 10))
+
+    self.assertEqual(offboarding.window(v, date(2027, 3, 1)), (False, date(2027, 3, 2)))
+    self.assertEqual(offboarding.window(v, date(2027, 3, 2)), (True, None))
+
+  def test_unknown_type_never_opens(self):
+    v = values(user_type = 'intern', end = date(2027, 3, 10))
+
+    self.assertEqual(self.rules['offboarding'].window(v, date(2027, 3, 10)), (False, None))
+
+  def test_onboarding_closes_on_start_date(self):
+    onboarding = self.rules['onboarding']
+    v = values(start = date(2027, 3, 1))
+
+    self.assertEqual(onboarding.window(v, date(2027, 2, 28)), (True, None))
+    self.assertEqual(onboarding.window(v, date(2027, 3, 1)), (False, None))
+
+  def test_missing_date_never_opens(self):
+    self.assertEqual(self.rules['onboarding'].window(values(), date(2027, 3, 1)), (False, None))
+
+  def test_locked_users_are_skipped(self):
+    v = values(start = date(2027, 3, 1), end = date(2027, 3, 10), locked = True)
+
+    self.assertEqual(self.rules['onboarding'].window(v, date(2027, 2, 28)), (False, None))
+    # Offboarding includes locked users
+    self.assertEqual(self.rules['offboarding'].window(v, date(2027, 3, 1)), (True, None))
+
+  def test_without_date_always_open(self):
+    self.assertEqual(self.rules['my_tasks'].window(values(), date(2027, 3, 1)), (True, None))
+
+
+class ParseDaysTest(unittest.TestCase):
+  '''
+  Tests lifecycle.parse_days()
+  '''
+
+  def test_not_set(self):
+    self.assertIsNone(lifecycle.parse_days(None))
+    self.assertIsNone(lifecycle.parse_days(' '))
+
+  def test_integer(self):
+    self.assertEqual(lifecycle.parse_days('7'), 7)
+
+  def test_days_by_type(self):
+    self.assertEqual(lifecycle.parse_days('employee:28 freelancer:7'),
+      {'employee': 28, 'freelancer': 7})
+    self.assertEqual(lifecycle.parse_days('employee:28, freelancer:7'),
+      {'employee': 28, 'freelancer': 7})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# _*_ coding: utf-8
+
+from datetime import date
+import os
+import tempfile
+import unittest
+
+from sync_state import SyncState
+
+
+class ScheduleTest(unittest.TestCase):
+  '''
+  Tests SyncState.schedule() and SyncState.pop_due()
+  '''
+
+  def test_due_users_are_popped_once(self):
+    state = SyncState()
+    state.schedule('jane', date(2027, 2, 9))
+    state.schedule('john', date(2027, 3, 1))
+
+    self.assertEqual(state.pop_due(date(2027, 2, 8)), set())
+    self.assertEqual(state.pop_due(date(2027, 2, 9)), set(['jane']))
+    self.assertEqual(state.pop_due(date(2027, 2, 9)), set())
+    self.assertEqual(state.pop_due(date(2027, 12, 31)), set(['john']))
+
+  def test_overdue_users_are_due(self):
+    # A user due while the sync did not run is handled by the next run
+    state = SyncState()
+    state.schedule('jane', date(2027, 2, 9))
+
+    self.assertEqual(state.pop_due(date(2027, 3, 1)), set(['jane']))
+
+  def test_rescheduled_user_is_due_on_new_date(self):
+    # The entry for the old date stays in the queue, but is stale
+    state = SyncState()
+    state.schedule('jane', date(2027, 2, 9))
+    state.schedule('jane', date(2027, 3, 1))
+
+    self.assertEqual(state.pop_due(date(2027, 2, 9)), set())
+    self.assertEqual(state.pop_due(date(2027, 3, 1)), set(['jane']))
+
+  def test_unscheduled_user_is_never_due(self):
+    state = SyncState()
+    state.schedule('jane', date(2027, 2, 9))
+    state.schedule('jane', None)
+
+    self.assertEqual(state.pop_due(date(2027, 12, 31)), set())
+
+  def test_rules_changed_drops_schedule(self):
+    state = SyncState()
+    state.rules_changed('a')
+    state.schedule('jane', date(2027, 2, 9))
+
+    self.assertFalse(state.rules_changed('a'))
+    self.assertTrue(state.rules_changed('b'))
+    self.assertEqual(state.pop_due(date(2027, 12, 31)), set())
+
+  def test_schedule_is_saved(self):
+    with tempfile.TemporaryDirectory() as d:
+      state_file = os.path.join(d, 'state.json')
+
+      state = SyncState(state_file)
+      state.schedule('jane', date(2027, 2, 9))
+      state.schedule('john', date(2027, 2, 1))
+      state.schedule('john', date(2027, 3, 1))
+      state.save()
+
+      state = SyncState(state_file)
+      self.assertEqual(state.pop_due(date(2027, 2, 9)), set(['jane']))
+      self.assertEqual(state.pop_due(date(2027, 3, 1)), set(['john']))
+
+
+if __name__ == '__main__':
+  unittest.main()